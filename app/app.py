@@ -1,6 +1,7 @@
 
 from typing import (
     List,
+    Literal,
 )
 
 from fastapi import (
@@ -31,15 +32,19 @@ async def _lineup(
     must: List[str] = Query([]),
     buget: int = 100,
     ignore: List[str] = Query([]),
+    solver: Literal["nested", "mitm", "bnb", "parallel"] = "nested",
+    top: int = Query(1, ge=1),
 ):
 
-    pool = functions.remove_bad(
-        gather.player_pool(),
-        None,
-        must=set(must),
-    )
+    pool = gather.player_pool()
+    if solver != "bnb":
+        pool = functions.remove_bad(
+            pool,
+            None,
+            must=set(must),
+        )
 
-    lineup = optimizers.lineup(
+    lineups = optimizers.lineups(
         pool=pool,
         buget=buget * 10,
         ignore=tuple(ignore) if ignore else tuple(),
@@ -49,9 +54,18 @@ async def _lineup(
             tuple(p.name for p in pool if p.name in must and p.position == "MID"),
             tuple(p.name for p in pool if p.name in must and p.position == "FWD"),
             ),
+        solver=solver,
+        top=top,
         )
 
-    return templates.TemplateResponse("lineup.html", {"players": lineup, "request": request})
+    return templates.TemplateResponse(
+        "lineups.html" if top > 1 else "lineup.html",
+        {
+            "lineups": lineups,
+            "players": lineups[0] if lineups else [],
+            "request": request,
+        },
+    )
 
 
 @app.get("/transfer/{team_id}/")
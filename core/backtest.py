@@ -0,0 +1,216 @@
+import concurrent.futures
+import functools
+import json
+import os
+import pathlib
+import time
+import typing as T
+
+import pandas as pd
+from tqdm import tqdm
+
+from core import (
+    cache,
+    functions,
+    optimizers,
+    settings,
+    simulator,
+    structures,
+)
+
+# Positions in the historical data use GK for goalkeepers.
+_POSITIONS = {"GK": "GKP"}
+
+
+@functools.lru_cache(maxsize=None)
+def _history(folder: pathlib.Path) -> T.Dict[str, T.List[functions.GwRow]]:
+    # Every snapshot reads all rows of the season, read them once per process.
+    # Players are the season's own, by their name in its rows, not today's
+    # players, which would leave out everyone who has left the league since.
+    return {
+        name: list(rows)
+        for name, rows in functions.teams_gw_index(
+            folder / "teams.csv", folder / "merged_gw.csv", web_names=False
+        ).items()
+    }
+
+
+def gameweeks(folder: pathlib.Path) -> T.List[int]:
+    return sorted(
+        set(int(row.GW) for rows in _history(folder).values() for row in rows)
+    )
+
+
+def predict(
+    folder: pathlib.Path,
+    gameweek: int,
+    window: int = 3,
+) -> T.Tuple[
+    T.Dict[str, structures.Player],
+    T.Dict[str, float],
+    T.Dict[str, float],
+]:
+
+    # Point in time snapshot: the models only see rows from before the
+    # gameweek. Returns every player seen so far, keyed by name, their
+    # realized points in the gameweek and the time spent per stage.
+    timings: T.Dict[str, float] = {}
+    start = time.perf_counter()
+
+    names, past, now, latest = [], [], [], []
+    for name, rows in _history(folder).items():
+        seen = [row for row in rows if row.GW <= gameweek]
+        if not seen:
+            continue
+        names.append(name)
+        past.append([row for row in seen if row.GW < gameweek])
+        now.append([row for row in seen if row.GW == gameweek])
+        latest.append(seen[0])
+
+    coefficients, features, _, known = simulator.fit(
+        [tuple(simulator.performances(rows, window)) for rows in past], window
+    )
+    timings["train"] = time.perf_counter() - start
+    start = time.perf_counter()
+
+    players, realized = {}, {}
+    for idx, name in enumerate(names):
+        xp = (
+            sum(
+                coefficients[idx].dot(features[idx])
+                / simulator.strength(row).mean()
+                for row in now[idx]
+            )
+            if known[idx]
+            else 0.0
+        )
+        position = latest[idx].position
+        players[name] = structures.Player(
+            name=name,
+            team=latest[idx].team,
+            position=_POSITIONS.get(position, position),
+            cost=int(latest[idx].value),
+            points=sum(int(row.total_points) for row in past[idx]),
+            xP=round(float(xp), 1),
+            news="" if now[idx] else "No fixture.",
+        )
+        realized[name] = float(sum(row.total_points for row in now[idx]))
+
+    timings["predict"] = time.perf_counter() - start
+    return players, realized, timings
+
+
+def run(
+    season: str,
+    max_transfers: int = 1,
+    buget: int = 1_000,
+    solver: T.Literal["nested", "mitm", "bnb", "parallel"] = "bnb",
+    workers: T.Optional[int] = None,
+    resume: bool = True,
+    window: int = 3,
+    folder: pathlib.Path = pathlib.Path("data"),
+) -> pd.DataFrame:
+
+    # The replay starts once a player can have window + 1 earlier rows,
+    # before that no model has anything to predict from.
+    season_folder = folder / season
+    weeks = gameweeks(season_folder)[window + 1 :]
+    workers = workers or os.cpu_count() or 1
+
+    # Everything the replay depends on, the data by the folder it is read
+    # from.
+    checkpoint = (
+        cache.CACHE_FOLDER
+        / "backtest"
+        / f"{season}_{max_transfers}_{buget}_{solver}_{window}_"
+        f"{cache.key(str(season_folder.resolve()))}.json"
+    )
+    state: T.Dict[str, T.Any] = {"squad": [], "bank": buget, "steps": []}
+    if resume and checkpoint.exists():
+        with checkpoint.open("r") as fd:
+            state = json.load(fd)
+    done = set(step["gameweek"] for step in state["steps"])
+    todo = [gw for gw in weeks if gw not in done]
+
+    # Snapshots only depend on the data, not on earlier picks, so they are
+    # built in parallel. Picks and transfers depend on the previous squad.
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        snapshots = executor.map(
+            predict,
+            (season_folder for _ in todo),
+            todo,
+            (window for _ in todo),
+        )
+
+        for gw, (players, realized, timings) in tqdm(
+            zip(todo, snapshots), total=len(todo)
+        ):
+            pool = [p for p in players.values() if not p.news]
+            squad = [players[name] for name in state["squad"]]
+            transfers: T.List[T.Tuple[str, str]] = []
+
+            start = time.perf_counter()
+            if not squad:
+                found = optimizers.lineups(
+                    pool=functions.remove_bad(pool, None, must=set()),
+                    buget=buget,
+                    solver=solver,
+                    top=1,
+                )
+                if not found:
+                    raise ValueError(f"No valid squad in gameweek {gw}.")
+                new = found[0]
+                timings["select"] = time.perf_counter() - start
+            else:
+                new = optimizers.Transfer.solve(
+                    old=squad,
+                    pool=pool,
+                    tc=structures.TransferConstraints(
+                        max_transfers=max_transfers,
+                        add=(),
+                        remove=(),
+                        ignore=(),
+                        buget=functions.lineup_cost(squad) + state["bank"],
+                    ),
+                    workers=1,
+                )
+                outs = sorted(set(squad) - set(new), key=lambda p: p.name)
+                ins = sorted(set(new) - set(squad), key=lambda p: p.name)
+                transfers = [(o.name, i.name) for o, i in zip(outs, ins)]
+                timings["transfer"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            xi = optimizers.gmw_lineup(new, gmw=gw)
+            timings["score"] = time.perf_counter() - start
+
+            state["bank"] = (
+                state["bank"]
+                + functions.lineup_cost(squad)
+                - functions.lineup_cost(new)
+            )
+            state["squad"] = [p.name for p in new]
+            state["steps"].append(
+                {
+                    "gameweek": gw,
+                    "transfers": transfers,
+                    "xP": functions.lineup_xp(xi),
+                    "points": sum(realized[p.name] for p in xi),
+                    "bank": state["bank"],
+                    **{f"{k} (s)": round(v, 3) for k, v in timings.items()},
+                }
+            )
+
+            cache.write(checkpoint, json.dumps(state).encode())
+
+            if settings.Global.verbose:
+                print(state["steps"][-1])
+
+    return pd.DataFrame(state["steps"]).fillna(0.0)
+
+
+def report(steps: pd.DataFrame) -> None:
+    print(steps.to_string(index=False))
+    print()
+    print(f"Total points: {steps['points'].sum()}, xP: {round(steps['xP'].sum(), 1)}")
+    for column in (c for c in steps.columns if c.endswith("(s)")):
+        print(f"{column:<14}: {round(steps[column].sum(), 2)}")
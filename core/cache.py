@@ -1,36 +1,114 @@
-
+import collections as C
 import functools
+import gzip
+import hashlib
 import json
+import os
 import pathlib
+import threading
+import time
+import typing as T
+
+from core import settings
 
 CACHE_FOLDER = pathlib.Path("./.cache/")
 
 
+def key(*args, **kw) -> str:
+    # Stable across processes and Python versions, unlike hash().
+    raw = json.dumps([args, sorted(kw.items())], default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def path(postfix: str, *args, **kw) -> pathlib.Path:
+    # Where file(postfix) stores the result of a call with these arguments.
+    suffix = ".json.gz" if settings.Cache.compress else ".json"
+    return CACHE_FOLDER / postfix / f"{key(*args, **kw)}{suffix}"
+
+
+def expires(postfix: str, file: pathlib.Path) -> float:
+    # When a stored entry goes stale, its age is taken from the file.
+    ttl = settings.Cache.ttl.get(postfix)
+    if ttl is None:
+        return float("inf")
+    return file.stat().st_mtime + ttl
+
+
+def sidecar(file: pathlib.Path) -> pathlib.Path:
+    # Validators (ETag, Last-Modified) of a downloaded file, they only hold
+    # for the body they came with.
+    return file.with_name(f"{file.name}.meta")
+
+
+def encode(file: pathlib.Path, body: bytes) -> bytes:
+    return gzip.compress(body) if file.suffix == ".gz" else body
+
+
+def read(file: pathlib.Path) -> T.Any:
+    body = file.read_bytes()
+    return json.loads(gzip.decompress(body) if file.suffix == ".gz" else body)
+
+
+def write(file: pathlib.Path, body: bytes) -> None:
+    # Written next to the target and renamed over it, readers never see a
+    # partial file.
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_name(f"{file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp.write_bytes(encode(file, body))
+        os.replace(tmp, file)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
 def file(postfix: str):
     def outer(f):
 
-        folder = CACHE_FOLDER / postfix
+        # Memory tier: the most recently used results of this function, with
+        # the time they expire. Disk tier: one file per call under postfix.
+        memory: T.OrderedDict[str, T.Tuple[float, T.Any]] = C.OrderedDict()
+        lock = threading.Lock()
 
-        @functools.lru_cache(maxsize=None, typed=False)
+        @functools.wraps(f)
         def inner(*args, **kw):
 
-            key = functools._make_key(args, kw, typed=False)
-            cache = folder / f"{key}.json"
-
-            if cache.exists():
-                with cache.open("r") as fd:
-                    return json.load(fd)
+            k = key(*args, **kw)
+            with lock:
+                if k in memory and time.time() < memory[k][0]:
+                    memory.move_to_end(k)
+                    return memory[k][1]
 
-            rv = f(*args, *kw)
+            cache = path(postfix, *args, **kw)
+            try:
+                if time.time() >= expires(postfix, cache):
+                    raise FileNotFoundError(cache)
+                rv = read(cache)
+            except (OSError, EOFError, ValueError):
+                # Missing, stale or unreadable, e.g. cut short by a crash
+                # before writes were atomic.
+                rv = f(*args, **kw)
+                sidecar(cache).unlink(missing_ok=True)
+                write(cache, json.dumps(rv).encode())
 
-            if not folder.exists():
-                folder.mkdir(parents=True, exist_ok=True)
-
-            with cache.open("w") as fd:
-                json.dump(rv, fd)
+            # Kept in memory for the namespace TTL from now, whatever the
+            # age of the file it was read from.
+            ttl = settings.Cache.ttl.get(postfix)
+            with lock:
+                memory[k] = (
+                    float("inf") if ttl is None else time.time() + ttl,
+                    rv,
+                )
+                memory.move_to_end(k)
+                while len(memory) > settings.Cache.memory:
+                    memory.popitem(last=False)
 
             return rv
 
+        def cache_clear() -> None:
+            with lock:
+                memory.clear()
+
+        inner.cache_clear = cache_clear  # type: ignore[attr-defined]
         return inner
 
     return outer
@@ -0,0 +1,235 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+import typing as T
+
+import aiofiles
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import (
+    cache,
+    settings,
+)
+
+_session: T.Optional[requests.Session] = None
+_lock = threading.Lock()
+_next_slot = 0.0
+
+
+def session() -> requests.Session:
+    # One pooled keep-alive client for every request.
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=settings.Fetch.concurrency,
+                pool_maxsize=settings.Fetch.concurrency,
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _throttle() -> None:
+    # Spaces requests evenly at settings.Fetch.rate across all threads.
+    global _next_slot
+    with _lock:
+        now = time.monotonic()
+        slot = max(now, _next_slot)
+        _next_slot = slot + 1.0 / settings.Fetch.rate
+    time.sleep(max(0.0, slot - now))
+
+
+def _retry_after(response: T.Optional[requests.Response], attempt: int) -> float:
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    # Full jitter, so clients backing off together do not retry together.
+    return random.uniform(0, settings.Fetch.backoff * 2**attempt)
+
+
+def _response(
+    url: str,
+    params: T.Optional[T.Dict[str, T.Any]] = None,
+    client: T.Optional[requests.Session] = None,
+    headers: T.Optional[T.Dict[str, str]] = None,
+    stream: bool = False,
+) -> requests.Response:
+
+    # Timeouts, connection errors, 429 and 5xx are retried with backoff,
+    # other errors raise. Nothing is returned, and so nothing cached,
+    # unless the request succeeded or was not modified.
+    client = client or session()
+
+    for attempt in range(settings.Fetch.retries + 1):
+        _throttle()
+        response = None
+        try:
+            response = client.get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=settings.Fetch.timeout,
+                stream=stream,
+            )
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == settings.Fetch.retries:
+                raise
+
+        if attempt == settings.Fetch.retries:
+            assert response is not None
+            response.raise_for_status()
+
+        if settings.Global.verbose:
+            status = response.status_code if response is not None else "error"
+            print(f"fetch -> RETRY({attempt + 1}, {status}) -> {url}")
+        if response is not None:
+            response.close()
+        time.sleep(_retry_after(response, attempt))
+
+    raise AssertionError("unreachable")
+
+
+def content(
+    url: str,
+    params: T.Optional[T.Dict[str, T.Any]] = None,
+    client: T.Optional[requests.Session] = None,
+) -> bytes:
+    return _response(url, params, client).content
+
+
+def stream(
+    url: str,
+    path: pathlib.Path,
+    params: T.Optional[T.Dict[str, T.Any]] = None,
+    client: T.Optional[requests.Session] = None,
+    chunk: int = 1 << 16,
+) -> str:
+
+    # Writes the body to path chunk by chunk, it is never held in memory,
+    # and returns its sha256. The file only appears once complete.
+    digest = hashlib.sha256()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with _response(url, params, client, stream=True) as response:
+            with tmp.open("wb") as fd:
+                for block in response.iter_content(chunk):
+                    digest.update(block)
+                    fd.write(block)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return digest.hexdigest()
+
+
+def get(
+    url: str,
+    params: T.Optional[T.Dict[str, T.Any]] = None,
+    client: T.Optional[requests.Session] = None,
+) -> T.Any:
+    return json.loads(content(url, params, client))
+
+
+async def _download(
+    jobs: T.Sequence[T.Tuple[str, T.Optional[T.Dict[str, T.Any]], pathlib.Path]],
+) -> T.List[T.Union[bool, BaseException]]:
+
+    semaphore = asyncio.Semaphore(settings.Fetch.concurrency)
+
+    async def one(url, params, path: pathlib.Path) -> bool:
+
+        headers = {}
+        sidecar = cache.sidecar(path)
+        if path.exists() and sidecar.exists():
+            async with aiofiles.open(sidecar, "r") as fd:
+                validators = json.loads(await fd.read())
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        async with semaphore:
+            response = await asyncio.to_thread(_response, url, params, None, headers)
+
+        if response.status_code == 304:
+            # Still current, which renews it for the cache TTL.
+            os.utime(path)
+            return False
+
+        json.loads(response.content)
+        for target, body in (
+            (path, response.content),
+            (
+                sidecar,
+                json.dumps(
+                    {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    }
+                ).encode(),
+            ),
+        ):
+            await asyncio.to_thread(cache.write, target, body)
+        return True
+
+    return await asyncio.gather(
+        *(one(*job) for job in jobs), return_exceptions=True
+    )
+
+
+@T.overload
+def download(
+    jobs: T.Iterable[T.Tuple[str, T.Optional[T.Dict[str, T.Any]], pathlib.Path]],
+    return_exceptions: T.Literal[False] = False,
+) -> T.List[bool]:
+    ...
+
+
+@T.overload
+def download(
+    jobs: T.Iterable[T.Tuple[str, T.Optional[T.Dict[str, T.Any]], pathlib.Path]],
+    return_exceptions: T.Literal[True],
+) -> T.List[T.Union[bool, BaseException]]:
+    ...
+
+
+def download(
+    jobs: T.Iterable[T.Tuple[str, T.Optional[T.Dict[str, T.Any]], pathlib.Path]],
+    return_exceptions: bool = False,
+) -> T.Sequence[T.Union[bool, BaseException]]:
+
+    # Fetches many JSON documents concurrently and writes the raw bodies to
+    # their paths, e.g. cache.path of the fetcher that would read them.
+    # Files downloaded before are requested conditionally. Returns, per
+    # job, whether the file was (re)written or was not modified. A failed
+    # job does not stop the others, its error is raised once all are done,
+    # or returned in its place with return_exceptions.
+    jobs = list(jobs)
+    if not jobs:
+        return []
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        results = asyncio.run(_download(jobs))
+    else:
+        # Already inside an event loop (the web app), run on a fresh one.
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            results = executor.submit(asyncio.run, _download(jobs)).result()
+
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+    return results
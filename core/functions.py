@@ -1,9 +1,11 @@
 import functools
+import itertools
 import json
 import pathlib
 import statistics
 import typing as T
 
+import numpy as np
 import pandas as pd
 
 from core import (
@@ -12,22 +14,35 @@ from core import (
 )
 
 
+def _column(
+    lineup: T.Union[T.Sequence[structures.Player], structures.PlayerTable],
+    field: str,
+) -> T.Sequence:
+    # Values of one Player field, a PlayerTable already holds them as a column.
+    if isinstance(lineup, structures.PlayerTable):
+        return getattr(lineup, field).tolist()
+    return [getattr(p, field) for p in lineup]
+
+
 def lineup_cost(
-    lineup: T.List[structures.Player],
+    lineup: T.Union[T.Sequence[structures.Player], structures.PlayerTable],
     acc=sum,
 ):
-    return round(acc(player.cost for player in lineup), 5)
+    return round(acc(_column(lineup, "cost")), 5)
 
 
 def lineup_xp(
-    lineup: T.Sequence[structures.Player],
+    lineup: T.Union[T.Sequence[structures.Player], structures.PlayerTable],
     acc=sum,
 ) -> float:
-    return round(acc(p.xP for p in lineup), 1)
+    return round(acc(_column(lineup, "xP")), 1)
 
 
-def lineup_tp(lineup: T.Sequence[structures.Player], acc=sum) -> float:
-    return round(acc(p.points for p in lineup), 1)
+def lineup_tp(
+    lineup: T.Union[T.Sequence[structures.Player], structures.PlayerTable],
+    acc=sum,
+) -> float:
+    return round(acc(_column(lineup, "points")), 1)
 
 
 def lprint(lineup: T.List[structures.Player]) -> None:
@@ -83,20 +98,62 @@ def tprint(
         print(f"{str(o):<{rs}} => {str(n):>2}")
 
 
+def dprint(
+    distribution: structures.Distribution,
+    prefix="",
+) -> None:
+    quantiles = ", ".join(
+        f"{round(100 * q)}%: {round(v, 1)}" for q, v in distribution.quantiles
+    )
+    print(
+        f"{prefix}mean: {round(distribution.mean, 1)}, "
+        f"sd: {round(distribution.variance**0.5, 1)}, {quantiles}"
+    )
+
+
+@T.overload
 def remove_bad(
     pool: T.List[structures.Player],
     min_xp: T.Optional[float],
     must: T.Set[str],
 ) -> T.List[structures.Player]:
+    ...
+
 
-    cutoff = {}
-    for pos in set(p.position for p in pool):
+@T.overload
+def remove_bad(
+    pool: structures.PlayerTable,
+    min_xp: T.Optional[float],
+    must: T.Set[str],
+) -> structures.PlayerTable:
+    ...
+
+
+def remove_bad(
+    pool: T.Union[T.List[structures.Player], structures.PlayerTable],
+    min_xp: T.Optional[float],
+    must: T.Set[str],
+) -> T.Union[T.List[structures.Player], structures.PlayerTable]:
+
+    # Works on the table columns, a list in gives a list out.
+    table = (
+        pool
+        if isinstance(pool, structures.PlayerTable)
+        else structures.PlayerTable.from_players(pool)
+    )
+
+    keep = np.isin(table.name, list(must))
+    for code in np.unique(table.position).tolist():
+        rows = table.position == code
         if min_xp is None:
-            cutoff[pos] = statistics.variance([p.xP for p in pool if p.position == pos])
+            cutoff = statistics.variance(table.xP[rows].tolist())
         else:
-            cutoff[pos] = min_xp
+            cutoff = min_xp
+        keep |= rows & (table.xP >= cutoff)
 
-    return [p for p in pool if p.xP >= cutoff[p.position] or p.name in must]
+    if isinstance(pool, structures.PlayerTable):
+        return table[keep]
+    return [p for p, k in zip(pool, keep.tolist()) if k]
 
 
 def summary(
@@ -125,18 +182,200 @@ def cached_csv_read(path: pathlib.Path) -> pd.DataFrame:
     return pd.read_csv(path)
 
 
+# The gameweek columns used by the models and the backtest, everything else in
+# merged_gw.csv is dropped when a season is converted.
+GW_COLUMNS = (
+    "name",
+    "GW",
+    "total_points",
+    "was_home",
+    "opponent_team",
+    "value",
+    "position",
+    "team",
+)
+
+STRENGTH_COLUMNS = (
+    "strength_attack_home",
+    "strength_attack_away",
+    "strength_defence_home",
+    "strength_defence_away",
+    "strength_overall_home",
+    "strength_overall_away",
+)
+
+
+class GwRow(T.NamedTuple):
+
+    # One merged history row: GW_COLUMNS after the name, then the opponent's
+    # STRENGTH_COLUMNS. Columns a season does not have are None.
+    web_name: str
+    GW: int
+    total_points: int
+    was_home: bool
+    opponent_team: int
+    value: int
+    position: str
+    team: str
+    strength_attack_home: int
+    strength_attack_away: int
+    strength_defence_home: int
+    strength_defence_away: int
+    strength_overall_home: int
+    strength_overall_away: int
+
+
+# The fields are spelled out for type checkers, they must follow the columns.
+assert GwRow._fields == ("web_name",) + GW_COLUMNS[1:] + STRENGTH_COLUMNS
+
+
+def _convert(gw: pathlib.Path, folder: pathlib.Path, stamp: str) -> None:
+
+    # Rows are stored sorted by name and then GW descending, so every player
+    # is one contiguous range given by offsets. Text columns become integer
+    # codes into a "<column>.names" dictionary.
+    csv = pd.read_csv(gw, usecols=lambda c: c in GW_COLUMNS)
+    names, codes = np.unique(csv["name"].to_numpy(dtype=str), return_inverse=True)
+    order = np.lexsort((-csv["GW"].to_numpy(), codes))
+
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / "done").unlink(missing_ok=True)
+
+    np.save(folder / "name.names.npy", names)
+    np.save(
+        folder / "offsets.npy",
+        np.searchsorted(codes[order], np.arange(len(names) + 1)),
+    )
+    for column in csv.columns.drop("name"):
+        values = csv[column].to_numpy()[order]
+        if values.dtype == object:
+            dictionary, values = np.unique(values.astype(str), return_inverse=True)
+            np.save(folder / f"{column}.names.npy", dictionary)
+        np.save(folder / f"{column}.npy", values)
+
+    (folder / "done").write_text(stamp)
+
+
+@functools.lru_cache(maxsize=None)
+def columnar(gw: pathlib.Path) -> T.Dict[str, np.ndarray]:
+
+    # One time conversion of a season's merged_gw.csv into typed .npy columns,
+    # redone when the CSV changes. Later runs only memory map the columns.
+    folder = gw.with_suffix(".columns")
+    stat = gw.stat()
+    stamp = f"{stat.st_size}-{stat.st_mtime_ns}"
+    done = folder / "done"
+    if not done.exists() or done.read_text() != stamp:
+        _convert(gw, folder, stamp)
+
+    return {
+        file.name[: -len(".npy")]: np.load(file, mmap_mode="r")
+        for file in folder.glob("*.npy")
+    }
+
+
+class GwRows:
+
+    # A player's rows in one season, read from the memory mapped columns on
+    # iteration. Slices of the columns are views, nothing is copied up front.
+
+    def __init__(
+        self,
+        web_name: str,
+        columns: T.Dict[str, np.ndarray],
+        known: np.ndarray,
+        strengths: T.Dict[str, np.ndarray],
+        ranges: T.List[T.Tuple[int, int]],
+    ):
+        self.web_name = web_name
+        self.columns = columns
+        self.known = known
+        self.strengths = strengths
+        self.ranges = ranges
+
+    def __iter__(self) -> T.Iterator[GwRow]:
+
+        select: T.Union[slice, np.ndarray]
+        if len(self.ranges) == 1:
+            select = slice(*self.ranges[0])
+        else:
+            # Several full names share this web_name, interleave them by GW.
+            select = np.concatenate([np.arange(*r) for r in self.ranges])
+            select = select[np.argsort(-self.columns["GW"][select], kind="stable")]
+
+        # Rows against an opponent missing from teams.csv are skipped.
+        opponents = np.asarray(self.columns["opponent_team"][select])
+        keep = (opponents >= 0) & (opponents < len(self.known))
+        keep[keep] = self.known[opponents[keep]]
+        opponents = opponents[keep]
+
+        values: T.List[T.Iterable[T.Any]] = []
+        for column in GW_COLUMNS[1:]:
+            if column not in self.columns:
+                values.append(itertools.repeat(None))
+                continue
+            value = np.asarray(self.columns[column][select])[keep]
+            if f"{column}.names" in self.columns:
+                value = self.columns[f"{column}.names"][value]
+            values.append(value.tolist())
+        for column in STRENGTH_COLUMNS:
+            if column in self.strengths:
+                values.append(self.strengths[column][opponents].tolist())
+            else:
+                values.append(itertools.repeat(None))
+
+        yield from map(GwRow, itertools.repeat(self.web_name), *values)
+
+
+@functools.lru_cache(maxsize=None)
+def teams_gw_index(
+    teams: pathlib.Path,
+    gw: pathlib.Path,
+    web_names: bool = True,
+) -> T.Dict[str, GwRows]:
+
+    # Rows per player, GW descending, with the opponent's strength joined on.
+    # Keyed by the current web_name of the player, players no longer listed
+    # are left out. Without web_names the season's own names are the keys,
+    # so every player of the season is kept.
+    columns = columnar(gw)
+    _teams = cached_csv_read(teams)
+
+    # Dense lookups from opponent id to the team's strengths.
+    ids = _teams["id"].to_numpy()
+    known = np.zeros(ids.max() + 1, dtype=bool)
+    known[ids] = True
+    strengths = {}
+    for column in STRENGTH_COLUMNS:
+        if column in _teams:
+            strengths[column] = np.zeros(len(known), dtype=_teams[column].dtype)
+            strengths[column][ids] = _teams[column].to_numpy()
+
+    offsets = columns["offsets"]
+    ranges: T.Dict[str, T.List[T.Tuple[int, int]]] = {}
+    for code, name in enumerate(columns["name.names"].tolist()):
+        web_name = gather.fullname_to_web_name(name) if web_names else name
+        if web_name is not None:
+            ranges.setdefault(web_name, []).append(
+                (int(offsets[code]), int(offsets[code + 1]))
+            )
+
+    return {
+        web_name: GwRows(web_name, columns, known, strengths, r)
+        for web_name, r in ranges.items()
+    }
+
+
 @functools.lru_cache(maxsize=None)
 def teams_gw_merge(
     teams: pathlib.Path,
     gw: pathlib.Path,
 ) -> pd.DataFrame:
 
-    _teams = cached_csv_read(teams)
-    _gw = cached_csv_read(gw)
-
-    merged = _gw.merge(_teams, left_on="opponent_team", right_on="id")
-    merged.sort_values("GW", inplace=True, ascending=False)
-    merged["web_name"] = merged.name_x.apply(gather.fullname_to_web_name)
-    merged = merged[merged["web_name"].notna()]
-    merged.reset_index(inplace=True)
+    merged = pd.DataFrame(
+        [row for rows in teams_gw_index(teams, gw).values() for row in rows],
+        columns=GwRow._fields,
+    )
+    merged.sort_values("GW", inplace=True, ascending=False, kind="stable")
+    merged.reset_index(drop=True, inplace=True)
     return merged
@@ -1,8 +1,10 @@
-import concurrent.futures
+import collections as C
+import dataclasses
 import os
 import pathlib
 import functools
 import shutil
+import time
 import typing as T
 
 import numpy as np
@@ -11,28 +13,34 @@ import requests
 
 from core import (
     cache,
+    fetch,
     functions,
+    ingest,
     settings,
     simulator,
     structures,
 )
 
 
+BOOTSTRAP_STATIC = "https://fantasy.premierleague.com/api/bootstrap-static/"
+FIXTURES = "https://fantasy.premierleague.com/api/fixtures/"
+
+
 @cache.file("bootstrap_static")
-def bootstrap_static(url="https://fantasy.premierleague.com/api/bootstrap-static/"):
+def bootstrap_static(url=BOOTSTRAP_STATIC):
     if settings.Global.verbose:
         print(f"bootstrap_static -> GET -> {url}")
-    return requests.get(url).json()
+    return fetch.get(url)
 
 
 @cache.file("gameweek")
 def gameweek(
     round: int,
-    url="https://fantasy.premierleague.com/api/fixtures/",
+    url=FIXTURES,
 ):
     if settings.Global.verbose:
         print(f"gameweek -> GET -> {url}")
-    return requests.get(url, params={"event": round}).json()
+    return fetch.get(url, params={"event": round})
 
 
 def current_gameweek() -> int:
@@ -46,37 +54,51 @@ def positions():
     yield from ("GKP", "DEF", "MID", "FWD")
 
 
+_lookups: T.Tuple[T.Any, T.Dict[str, T.Dict[T.Any, T.Dict]]] = (None, {})
+
+
+def _lookup(kind: str) -> T.Dict[T.Any, T.Dict]:
+
+    # Dict indexes over the bootstrap snapshot, rebuilt whenever
+    # bootstrap_static hands out a different snapshot. Iterating in reverse
+    # keeps the first match on duplicate keys, like a linear scan would.
+    global _lookups
+
+    snapshot = bootstrap_static()
+    indexed, lookups = _lookups
+
+    if indexed is not snapshot:
+        lookups = {
+            "team_code": {t["code"]: t for t in reversed(snapshot["teams"])},
+            "team_id": {t["id"]: t for t in reversed(snapshot["teams"])},
+            "element_type": {
+                et["id"]: et for et in reversed(snapshot["element_types"])
+            },
+            "element_id": {e["id"]: e for e in reversed(snapshot["elements"])},
+            "web_name": {e["web_name"]: e for e in reversed(snapshot["elements"])},
+        }
+        _lookups = (snapshot, lookups)
+
+    return lookups[kind]
+
+
 def team_name(team_code):
-    for team in bootstrap_static()["teams"]:
-        if team["code"] == team_code:
-            return team["short_name"]
+    team = _lookup("team_code").get(team_code)
+    return team["short_name"] if team else None
 
 
 def team_id_team_name(team_id):
-    for team in bootstrap_static()["teams"]:
-        if team["id"] == team_id:
-            return team["short_name"]
+    team = _lookup("team_id").get(team_id)
+    return team["short_name"] if team else None
 
 
 def position(element_type_id):
-    for element_type in bootstrap_static()["element_types"]:
-        if element_type["id"] == element_type_id:
-            return element_type["singular_name_short"]
-
-
-@cache.file("element_summary")
-def element_summary(element_id: int):
-    url = f"https://fantasy.premierleague.com/api/element-summary/{element_id}/"
-    if settings.Global.verbose:
-        print(f"element_summary -> GET -> {url}")
-    return requests.get(url).json()
+    element_type = _lookup("element_type").get(element_type_id)
+    return element_type["singular_name_short"] if element_type else None
 
 
 def name_to_element_id(name: str) -> int:
-    for element in bootstrap_static()["elements"]:
-        if element["web_name"] == name:
-            return element["id"]
-    raise KeyError
+    return _lookup("web_name")[name]["id"]
 
 
 def fullname_to_web_name(full: str) -> T.Optional[str]:
@@ -89,27 +111,85 @@ def fullname_to_web_name(full: str) -> T.Optional[str]:
 def history(
     player: str,
     folder=pathlib.Path("data"),
-) -> T.Generator[pd.Series, None, None]:
+) -> T.Generator["functions.GwRow", None, None]:
 
     # Data from 2020/2021 and 2021/2022
     for fold in sorted(folder.glob("*_*/"), reverse=True):
 
-        merged = functions.teams_gw_merge(
+        index = functions.teams_gw_index(
             fold / "teams.csv",
             fold / "merged_gw.csv",
         )
+        yield from index.get(player, ())
 
-        mactch = merged.loc[merged["web_name"] == player]
-        yield from mactch.itertuples()
+
+@cache.file("fixtures")
+def fixtures(url=FIXTURES):
+    if settings.Global.verbose:
+        print(f"fixtures -> GET -> {url}")
+    return fetch.get(url)
+
+
+@functools.cache
+def fixture_table() -> T.Tuple[
+    T.Dict[int, int],
+    np.ndarray,
+    np.ndarray,
+    np.ndarray,
+    np.ndarray,
+]:
+
+    # Every team's upcoming fixtures from the single fixtures endpoint, in
+    # kickoff order with unscheduled fixtures last. Returns the row per team
+    # id, the (team, fixture) opponent ids and home flags, the opponent
+    # (attack, defence, overall) strengths as seen from that team and the
+    # gameweek of each fixture, 0 while unscheduled.
+    teams = bootstrap_static()["teams"]
+    row = {team["id"]: idx for idx, team in enumerate(teams)}
+    upcoming: T.List[T.List[T.Tuple[int, bool, int]]] = [[] for _ in teams]
+
+    for f in sorted(
+        (f for f in fixtures() if not f["finished"]),
+        key=lambda f: (f["event"] is None, f["event"] or 0, f["kickoff_time"] or ""),
+    ):
+        upcoming[row[f["team_h"]]].append((f["team_a"], True, f["event"] or 0))
+        upcoming[row[f["team_a"]]].append((f["team_h"], False, f["event"] or 0))
+
+    slots = max((len(u) for u in upcoming), default=0)
+    opponents = np.zeros((len(teams), slots), dtype=np.int64)
+    home = np.zeros((len(teams), slots), dtype=bool)
+    strength = np.zeros((len(teams), slots, 3), dtype=np.int64)
+    event = np.zeros((len(teams), slots), dtype=np.int64)
+
+    for idx, team_fixtures in enumerate(upcoming):
+        for slot, (opponent, is_home, gameweek) in enumerate(team_fixtures):
+            # A home side faces the opponent's away strength and vice versa.
+            venue = "away" if is_home else "home"
+            team = teams[row[opponent]]
+            opponents[idx, slot] = opponent
+            home[idx, slot] = is_home
+            event[idx, slot] = gameweek
+            strength[idx, slot] = (
+                team[f"strength_attack_{venue}"],
+                team[f"strength_defence_{venue}"],
+                team[f"strength_overall_{venue}"],
+            )
+
+    return row, opponents, home, strength, event
+
+
+def player_team(player: str) -> int:
+    return _lookup("web_name")[player]["team"]
 
 
 def next_n(
     player: str,
     n: int = 3,
 ) -> T.Tuple[T.Tuple[int, bool], ...]:
+    row, opponents, home, *_ = fixture_table()
+    idx = row[player_team(player)]
     return tuple(
-        (f["team_a"], f["is_home"]) if f["is_home"] else (f["team_h"], f["is_home"])
-        for f in element_summary(name_to_element_id(player))["fixtures"][:n]
+        (int(o), bool(h)) for o, h in zip(opponents[idx, :n], home[idx, :n]) if o
     )
 
 
@@ -117,48 +197,60 @@ def strength_next_n(
     player: str,
     n: int = 3,
 ) -> T.Tuple[structures.Strength, ...]:
-    def _strength(team_id: int, home: bool):
-        for team in bootstrap_static()["teams"]:
-            if team["id"] == team_id:
-                if not home:
-                    return structures.Strength(
-                        attack=team["strength_attack_home"],
-                        defence=team["strength_defence_home"],
-                        overall=team["strength_overall_home"],
-                        home=home,
-                    )
-                return structures.Strength(
-                    attack=team["strength_attack_away"],
-                    defence=team["strength_defence_away"],
-                    overall=team["strength_overall_away"],
-                    home=home,
-                )
-
-        raise KeyError(team_id)
-
-    return tuple(_strength(*opponent) for opponent in next_n(player=player, n=n))
+    row, opponents, home, strength, _ = fixture_table()
+    idx = row[player_team(player)]
+    return tuple(
+        structures.Strength(
+            attack=int(s[0]),
+            defence=int(s[1]),
+            overall=int(s[2]),
+            home=bool(h),
+        )
+        for o, h, s in zip(opponents[idx, :n], home[idx, :n], strength[idx, :n])
+        if o
+    )
 
 
 @functools.cache
-def player_pool() -> T.List[structures.Player]:
+def player_table() -> structures.PlayerTable:
 
-    pool_pd = pd.DataFrame.from_dict(bootstrap_static()["elements"])
+    elements = pd.DataFrame.from_dict(bootstrap_static()["elements"])
+    simulator.train(elements["web_name"], prune=True)
 
-    pool_pd["position"] = pool_pd["element_type"].apply(position)
-    pool_pd["team"] = pool_pd["team_code"].apply(team_name)
+    teams = elements["team_code"].map(
+        {code: team["short_name"] for code, team in _lookup("team_code").items()}
+    )
+    team, names = pd.factorize(teams, sort=True)
+    names = tuple(names)
+    if (team < 0).any():
+        # A team code missing from the bootstrap teams is factorized to -1,
+        # which would index the last team. Such players get an unnamed team.
+        team = np.where(team < 0, len(names), team)
+        names += ("",)
+    # Element types beyond the four positions are kept, after them, like
+    # PlayerTable.from_players does.
+    short = elements["element_type"].map(position)
+    order = tuple(positions())
+    order += tuple(sorted(set(short) - set(order)))
+    position_code = short.map({p: code for code, p in enumerate(order)})
+
+    return structures.PlayerTable(
+        name=elements["web_name"].to_numpy(dtype=object),
+        team=team,
+        position=position_code.to_numpy(dtype=np.int64),
+        news=elements["news"].to_numpy(dtype=object),
+        cost=elements["now_cost"].to_numpy(),
+        points=elements["total_points"].to_numpy(),
+        xP=simulator.expected(elements["web_name"].tolist()),
+        teams=names,
+        positions=order,
+        id=elements["id"].to_numpy(dtype=np.int64),
+    )
 
-    return [
-        structures.Player(
-            name=row.web_name,
-            team=row.team,
-            position=row.position,
-            cost=row.now_cost,
-            points=row.total_points,
-            xP=simulator.Model(row.web_name).xP(),
-            news=row.news,
-        )
-        for _, row in pool_pd.iterrows()
-    ]
+
+@functools.cache
+def player_pool() -> T.List[structures.Player]:
+    return player_table().players()
 
 
 @cache.file("my_team")
@@ -182,98 +274,152 @@ def my_team(
         url = "https://fantasy.premierleague.com/api/me/"
         if settings.Global.verbose:
             print(f"my_team -> GET -> {url}")
-        _me = s.get(url).json()
+        _me = fetch.get(url, client=s)
 
         url = f"https://fantasy.premierleague.com/api/my-team/{_me['player']['entry']}/"
         if settings.Global.verbose:
             print(f"my_team -> GET -> {url}")
-        return s.get(url).json()
-
+        return fetch.get(url, client=s)
 
-def team(_id = None):
 
-    def element(_id, key):
-        for element in bootstrap_static()["elements"]:
-            if element["id"] == _id:
-                return element[key]
+ENTRY_PICKS = "https://fantasy.premierleague.com/api/entry/{}/event/{}/picks/"
 
-    if _id is None:
-        picks = pd.DataFrame.from_dict(my_team()["picks"])
-    else:
-        print(f"https://fantasy.premierleague.com/api/entry/{_id}/event/{current_gameweek()-1}/picks/")
-        picks = pd.DataFrame.from_dict(
-            requests.get(f"https://fantasy.premierleague.com/api/entry/{_id}/event/{current_gameweek()-1}/picks/").json()["picks"]
-        )
-
-    picks["minutes"] = picks.element.apply(lambda r: element(r, "minutes")).apply(float)
-    picks["now_cost"] = picks.element.apply(lambda r: element(r, "now_cost"))
-    picks["position"] = picks.element.apply(
-        lambda r: position(element(r, "element_type"))
-    )
-    picks["team"] = picks.element.apply(lambda r: team_name(element(r, "team_code")))
-    picks["total_points"] = picks.element.apply(
-        lambda r: element(r, "total_points")
-    ).apply(float)
-    picks["web_name"] = picks.element.apply(lambda r: element(r, "web_name"))
-
-    return [
-        structures.Player(
-            name=row.web_name,
-            team=row.team,
-            position=row.position,
-            cost=row.now_cost,
-            points=row.total_points,
-            xP=simulator.Model(row.web_name).xP(),
-            news="",
-        )
-        for _, row in picks.iterrows()
-    ]
 
+@cache.file("entry_picks")
+def entry_picks(
+    team_id: int,
+    gameweek: int,
+):
+    url = ENTRY_PICKS.format(team_id, gameweek)
+    if settings.Global.verbose:
+        print(f"entry_picks -> GET -> {url}")
+    return fetch.get(url)
 
-def refresh():
 
-    print(f"Invalidating: {cache.CACHE_FOLDER}/")
-    if cache.CACHE_FOLDER.exists():
-        shutil.rmtree(cache.CACHE_FOLDER)
+def teams(
+    ids: T.Iterable[int],
+) -> T.Dict[int, T.List[structures.Player]]:
 
-    # Run all the functions that do external calls.
-    elements = bootstrap_static()["elements"]
-    with concurrent.futures.ThreadPoolExecutor(16) as wp:
-        wp.map(element_summary, (e["id"] for e in elements))
-        wp.map(my_team)
+    # Picks missing from the cache are downloaded concurrently straight into
+    # it, then resolved by team(). Teams that are unknown, private or fail to
+    # download are reported and left out.
+    ids = tuple(ids)
+    gmw = current_gameweek() - 1
 
-    historic = (
-        (
-            pathlib.Path("data/2020_2021"),
-            "https://raw.githubusercontent.com/vaastav/Fantasy-Premier-League/master/data/2020-21/gws/merged_gw.csv",
-        ),
-        (
-            pathlib.Path("data/2020_2021"),
-            "https://raw.githubusercontent.com/vaastav/Fantasy-Premier-League/master/data/2020-21/teams.csv",
-        ),
+    missing = [i for i in ids if not cache.path("entry_picks", i, gmw).exists()]
+    results = fetch.download(
         (
-            pathlib.Path("data/2021_2022"),
-            "https://raw.githubusercontent.com/vaastav/Fantasy-Premier-League/master/data/2021-22/gws/merged_gw.csv",
-        ),
-        (
-            pathlib.Path("data/2021_2022"),
-            "https://raw.githubusercontent.com/vaastav/Fantasy-Premier-League/master/data/2021-22/teams.csv",
+            (ENTRY_PICKS.format(i, gmw), None, cache.path("entry_picks", i, gmw))
+            for i in missing
         ),
+        return_exceptions=True,
     )
+    failed = {
+        i: result
+        for i, result in zip(missing, results)
+        if isinstance(result, BaseException)
+    }
+
+    squads = {}
+    for _id in ids:
+        if _id in failed:
+            print(f"Skipping team {_id}: {failed[_id]!r}")
+            continue
+        try:
+            squads[_id] = team(_id)
+        except (KeyError, requests.RequestException) as e:
+            print(f"Skipping team {_id}: {e!r}")
+    return squads
+
+
+# Resolved squads per (team id, gameweek), None is my_team, with the time
+# they were resolved. Least recently used first, at most settings.Team.memory.
+_squads: T.OrderedDict[
+    T.Tuple[T.Optional[int], int], T.Tuple[float, T.List[structures.Player]]
+] = C.OrderedDict()
+
+
+def team(_id: T.Optional[int] = None) -> T.List[structures.Player]:
+
+    # Picks are resolved to player_table rows in one go, so cost, team,
+    # position and xP come from the pool instead of per pick lookups and
+    # retraining. Squads are reused for settings.Team.ttl seconds.
+    gmw = current_gameweek() - 1
+    key = (_id, gmw)
+    now = time.monotonic()
+    if key in _squads:
+        if now - _squads[key][0] < settings.Team.ttl:
+            _squads.move_to_end(key)
+            return list(_squads[key][1])
+        del _squads[key]
 
-    rs = max(len(url) for *_, url in historic)
+    if _id is None:
+        picks = my_team()["picks"]
+    else:
+        picks = entry_picks(_id, gmw)["picks"]
+
+    # Rows come from the ids of the table itself, a newer bootstrap snapshot
+    # may hold players the table does not.
+    table = player_table()
+    squad = table[table.rows([p["element"] for p in picks])]
+    squad = dataclasses.replace(
+        squad,
+        news=np.full(len(squad), "", dtype=object),
+        points=squad.points.astype(float),
+    )
 
-    for folder, url in historic:
+    _squads[key] = (now, squad.players())
+    while len(_squads) > settings.Team.memory:
+        _squads.popitem(last=False)
+    return list(_squads[key][1])
 
-        if not folder.exists():
-            folder.mkdir(parents=True, exist_ok=True)
 
-        *_, name = url.split("/")
-        file = folder / name
-        if settings.Global.verbose:
-            print(f"{str(url):<{rs}} => {str(folder):>2}.csv")
-        csv = pd.read_csv(url)
-        csv.to_csv(file)
+def refresh(full: bool = False):
+
+    if full:
+        print(f"Invalidating: {cache.CACHE_FOLDER}/")
+        if cache.CACHE_FOLDER.exists():
+            shutil.rmtree(cache.CACHE_FOLDER)
+
+        # Run all the functions that do external calls.
+        bootstrap_static()
+        fixtures()
+        ingest.run(force=True)
+        return
+
+    # Incremental: bootstrap and fixtures, which everything else is derived
+    # from, are requested conditionally. my_team and the per gameweek
+    # fixtures are dropped and fetched on next use, picks of finished
+    # gameweeks never change and are kept.
+    refetched = fetch.download(
+        (
+            (BOOTSTRAP_STATIC, None, cache.path("bootstrap_static")),
+            (FIXTURES, None, cache.path("fixtures")),
+        )
+    )
+
+    for postfix in ("my_team", "gameweek"):
+        shutil.rmtree(cache.CACHE_FOLDER / postfix, ignore_errors=True)
+
+    for cached_function in (
+        bootstrap_static,
+        fixtures,
+        gameweek,
+        my_team,
+        player_table,
+        player_pool,
+        fixture_table,
+    ):
+        cached_function.cache_clear()
+    _squads.clear()
+
+    downloaded = ingest.run()
+
+    print(
+        f"Refetched: {sum(refetched)}, "
+        f"not modified: {len(refetched) - sum(refetched)}, "
+        f"historical files downloaded: {downloaded}"
+    )
 
 
 def validate(
@@ -0,0 +1,168 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import typing as T
+
+import pandas as pd
+import requests
+from tqdm import tqdm
+
+from core import (
+    fetch,
+    settings,
+)
+
+# Columns later stages read, a season missing any of them is rejected.
+SCHEMA = {
+    "merged_gw.csv": (
+        "name",
+        "GW",
+        "total_points",
+        "was_home",
+        "opponent_team",
+    ),
+    "teams.csv": (
+        "id",
+        "strength_defence_home",
+        "strength_defence_away",
+        "strength_overall_home",
+        "strength_overall_away",
+    ),
+}
+
+MANIFEST = "manifest.json"
+
+
+def folder(
+    season: str,
+    root: pathlib.Path = pathlib.Path("data"),
+) -> pathlib.Path:
+    # Season "2021-22" is stored in data/2021_2022.
+    start, end = season.split("-")
+    return root / f"{start}_{start[:2]}{end}"
+
+
+def sha256(path: pathlib.Path, chunk: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fd:
+        for block in iter(lambda: fd.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete(target: pathlib.Path) -> bool:
+
+    # A season is complete once its manifest is written, which happens
+    # after every file was downloaded, validated and moved in place, and
+    # every file still has the size and checksum the manifest recorded.
+    manifest = target / MANIFEST
+    if not manifest.exists():
+        return False
+
+    with manifest.open("r") as fd:
+        files = json.load(fd)["files"]
+    return all(
+        (target / name).exists()
+        and (target / name).stat().st_size == meta["bytes"]
+        and sha256(target / name) == meta["sha256"]
+        for name, meta in files.items()
+    )
+
+
+def validate(path: pathlib.Path) -> None:
+    header = pd.read_csv(path, nrows=1)
+    if header.empty:
+        raise ValueError(f"{path.name}: no rows")
+    missing = [column for column in SCHEMA[path.name] if column not in header]
+    if missing:
+        raise ValueError(f"{path.name}: missing columns {', '.join(missing)}")
+
+
+def run(
+    seasons: T.Optional[T.Sequence[str]] = None,
+    force: bool = False,
+    root: pathlib.Path = pathlib.Path("data"),
+) -> int:
+
+    # Downloads all files of the seasons that are not complete in parallel,
+    # into a staging folder. A season is only moved into root once all of
+    # its files downloaded and passed validation, a failed season does not
+    # hold up the others. Returns the number of files downloaded.
+    seasons = seasons or settings.Seasons.past
+    todo = [s for s in seasons if force or not complete(folder(s, root))]
+    staging = root / ".ingest"
+
+    jobs = [
+        (
+            season,
+            name,
+            settings.Seasons.url.format(season=season, file=remote),
+        )
+        for season in todo
+        for name, remote in settings.Seasons.files.items()
+    ]
+
+    def download(job: T.Tuple[str, str, str]) -> str:
+        season, name, url = job
+        if settings.Global.verbose:
+            print(f"{url} => {folder(season, root) / name}")
+        return fetch.stream(url, folder(season, staging) / name)
+
+    errors: T.Dict[str, str] = {}
+    checksums: T.Dict[T.Tuple[str, str], str] = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            settings.Seasons.workers
+        ) as executor:
+            futures = {executor.submit(download, job): job for job in jobs}
+            for future in tqdm(
+                concurrent.futures.as_completed(futures),
+                total=len(jobs),
+                disable=not jobs,
+            ):
+                season, name, _ = futures[future]
+                try:
+                    checksums[(season, name)] = future.result()
+                except (OSError, requests.RequestException) as e:
+                    errors.setdefault(season, f"{name}: {e}")
+
+        for season in todo:
+            if season in errors:
+                continue
+
+            stage, target = folder(season, staging), folder(season, root)
+            files: T.Dict[str, T.Dict[str, T.Any]] = {
+                name: {"url": url, "sha256": checksums[(s, name)]}
+                for s, name, url in jobs
+                if s == season
+            }
+
+            try:
+                for name in files:
+                    validate(stage / name)
+            except ValueError as e:
+                errors[season] = str(e)
+                continue
+
+            target.mkdir(parents=True, exist_ok=True)
+            (target / MANIFEST).unlink(missing_ok=True)
+            for name, meta in files.items():
+                meta["bytes"] = (stage / name).stat().st_size
+                os.replace(stage / name, target / name)
+
+            tmp = target / f"{MANIFEST}.tmp"
+            with tmp.open("w") as fd:
+                json.dump({"season": season, "files": files}, fd, indent=2)
+            tmp.replace(target / MANIFEST)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if errors:
+        raise ValueError(
+            "\n".join(f"{season}, {error}" for season, error in errors.items())
+        )
+
+    return len(jobs)
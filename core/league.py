@@ -0,0 +1,89 @@
+import concurrent.futures
+import os
+import typing as T
+
+import pandas as pd
+from tqdm import tqdm
+
+from core import (
+    functions,
+    gather,
+    optimizers,
+    structures,
+)
+
+_state: T.Dict[str, T.Any] = {}
+
+
+def _init(
+    pool: T.List[structures.Player],
+    index: optimizers._Candidates,
+    max_transfers: int,
+) -> None:
+    _state.update(pool=pool, index=index, max_transfers=max_transfers)
+
+
+def _solve(
+    task: T.Tuple[int, T.List[structures.Player]],
+) -> T.Dict[str, T.Any]:
+
+    team_id, old = task
+    new = optimizers.Transfer.solve(
+        old=old,
+        pool=_state["pool"],
+        tc=structures.TransferConstraints(
+            max_transfers=_state["max_transfers"],
+            add=(),
+            remove=(),
+            ignore=(),
+            buget=functions.lineup_cost(old),
+        ),
+        workers=1,
+        index=_state["index"],
+    )
+
+    out = sorted(set(old) - set(new), key=lambda p: (p.position, p.name))
+    transfer_in = sorted(set(new) - set(old), key=lambda p: (p.position, p.name))
+
+    return {
+        "team": team_id,
+        "transfers": ", ".join(
+            f"{o.name} => {i.name}" for o, i in zip(out, transfer_in)
+        ),
+        "xP": functions.lineup_xp(old),
+        "new xP": functions.lineup_xp(new),
+        "gain": round(functions.lineup_xp(new) - functions.lineup_xp(old), 1),
+        "XI xP": functions.lineup_xp(optimizers.gmw_lineup(new)),
+    }
+
+
+def solve(
+    team_ids: T.Iterable[int],
+    max_transfers: int = 1,
+    min_xp: T.Optional[float] = None,
+    workers: T.Optional[int] = None,
+) -> pd.DataFrame:
+
+    # The filtered pool, its candidate index and xP values are built once and
+    # shared by every team; each worker process receives them a single time
+    # on start-up.
+    squads = gather.teams(team_ids)
+    pool = functions.remove_bad(gather.player_pool(), min_xp, must=set())
+    pool = sorted(pool, key=lambda p: p.xP)
+    index = optimizers.Transfer.candidates(pool)
+
+    workers = workers or os.cpu_count() or 1
+    tasks = list(squads.items())
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            workers,
+            initializer=_init,
+            initargs=(pool, index, max_transfers),
+        ) as executor:
+            rows = list(tqdm(executor.map(_solve, tasks), total=len(tasks)))
+    else:
+        _init(pool, index, max_transfers)
+        rows = [_solve(task) for task in tqdm(tasks)]
+
+    return pd.DataFrame(rows).sort_values("gain", ascending=False)
@@ -1,7 +1,15 @@
+import bisect
+import collections as C
+import concurrent.futures
+import dataclasses
 import functools
+import heapq
 import itertools
+import multiprocessing
+import os
 import typing as T
 
+import numpy as np
 from tqdm import (
     tqdm,
 )
@@ -16,6 +24,419 @@ from core import (
 )
 
 
+@dataclasses.dataclass(frozen=True)
+class _Bounds:
+    buget: int
+    min_cost_fwd: int
+    min_cost_mid_fwd: int
+    max_xp_fwd: float
+    max_xp_mid_fwd: float
+
+    def lvl1(self, c, best_xp: float) -> bool:
+        return (
+            functions.lineup_cost(c) <= self.buget - self.min_cost_mid_fwd
+            and functions.lineup_xp(c) + self.max_xp_mid_fwd > best_xp
+            and constraints.team_constraint(c)
+            and constraints.gkp_def_not_same_team(c)
+        )
+
+    def lvl2(self, c, best_xp: float) -> bool:
+        return (
+            functions.lineup_cost(c) <= self.buget - self.min_cost_fwd
+            and functions.lineup_xp(c) + self.max_xp_fwd > best_xp
+            and constraints.team_constraint(c)
+        )
+
+    def lvl3(self, c, best_xp: float) -> bool:
+        return (
+            functions.lineup_cost(c) <= self.buget
+            and functions.lineup_xp(c) > best_xp
+            and constraints.team_constraint(c)
+        )
+
+
+def _combinations(
+    table: structures.PlayerTable,
+    rows: T.Sequence[int],
+    k: int,
+    n: int,
+    must: T.Set[str],
+    top: int,
+    block: int = 1 << 16,
+) -> T.Tuple[np.ndarray, int]:
+
+    # The k player combinations of the table rows that _pareto keeps for
+    # top, in itertools order, as an index array with one combination per
+    # row, and how many there were before dominated ones were dropped.
+    # Combinations with more than n players from one team or missing a must
+    # player are dropped. They are generated and filtered block by block,
+    # and the dominated ones dropped whenever enough piled up, so only the
+    # frontier is held.
+    names = set(table.name[list(rows)].tolist())
+    if any(name not in names for name in must):
+        return np.empty((0, k), dtype=np.int64), 0
+
+    combinations = itertools.combinations(rows, k)
+    kept = [np.empty((0, k), dtype=np.int64)]
+    pending, count = 0, 0
+    while True:
+        chunk = np.fromiter(
+            itertools.chain.from_iterable(itertools.islice(combinations, block)),
+            dtype=np.int64,
+        ).reshape(-1, k)
+        if not len(chunk):
+            break
+
+        teams = table.team[chunk]
+        same = (teams[:, :, None] == teams[:, None, :]).sum(axis=2)
+        keep = same.max(axis=1, initial=0) <= n
+        for name in must:
+            keep &= (table.name[chunk] == name).any(axis=1)
+        kept.append(chunk[keep])
+
+        count += len(kept[-1])
+        pending += len(kept[-1])
+        if pending >= max(block * 16, len(kept[0])):
+            kept, pending = [_pareto(table, np.concatenate(kept), top)], 0
+
+    return _pareto(table, np.concatenate(kept), top), count
+
+
+def _sums(
+    table: structures.PlayerTable,
+    combinations: np.ndarray,
+) -> T.Tuple[np.ndarray, np.ndarray]:
+    # Cost and unrounded xP of every combination.
+    return (
+        table.cost[combinations].sum(axis=1),
+        table.xP[combinations].sum(axis=1),
+    )
+
+
+def _counts(
+    table: structures.PlayerTable,
+    combinations: np.ndarray,
+) -> np.ndarray:
+    # Players per team of every combination, one column per team.
+    counts = np.zeros((len(combinations), len(table.teams)), dtype=np.int8)
+    for column in combinations.T:
+        counts[np.arange(len(combinations)), table.team[column]] += 1
+    return counts
+
+
+def _compatible(
+    left: np.ndarray,
+    right: np.ndarray,
+    n: int = 2,
+    disjoint: bool = False,
+    block: int = 4_096,
+) -> np.ndarray:
+
+    # Which pairs of the left and right team counts together stay within n
+    # players per team, as a (left, right) mask. With disjoint no team may
+    # appear on both sides. Done in blocks of left rows to bound memory.
+    mask = np.zeros((len(left), len(right)), dtype=bool)
+    for start in range(0, len(left), block):
+        both = left[start : start + block, None, :] + right[None, :, :]
+        ok = both.max(axis=2, initial=0) <= n
+        if disjoint:
+            ok &= ~(
+                (left[start : start + block, None, :] > 0) & (right[None, :, :] > 0)
+            ).any(axis=2)
+        mask[start : start + block] = ok
+    return mask
+
+
+def _pairs(
+    table: structures.PlayerTable,
+    left: np.ndarray,
+    right: np.ndarray,
+    partner_cost: np.ndarray,
+    partner_xp: np.ndarray,
+    buget: int,
+    floor: float,
+    n: int = 2,
+    block: int = 1 << 20,
+) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+    # Row indexes into left and right of every pair that stays within n
+    # players per team and, with the best partner it can afford, fits the
+    # buget and scores more than floor. Returned with its cost and rounded
+    # xP, ordered by cost. Built a block of left rows at a time, only the
+    # kept pairs are held.
+    left_cost, left_xp = _sums(table, left)
+    right_cost, right_xp = _sums(table, right)
+    left_counts = _counts(table, left)
+    right_counts = _counts(table, right)
+
+    # Best partner xP within each cost, by cost.
+    order = np.argsort(partner_cost, kind="stable")
+    partner_cost = partner_cost[order]
+    partner_best = np.maximum.accumulate(partner_xp[order])
+
+    rows = max(1, block // max(1, len(right)))
+    kept = []
+    for start in range(0, len(left), rows):
+        cost = left_cost[start : start + rows, None] + right_cost[None, :]
+        xp = np.round(left_xp[start : start + rows, None] + right_xp[None, :], 1)
+        partner = np.searchsorted(partner_cost, buget - cost, side="right") - 1
+        ok = partner >= 0
+        ok[ok] = partner_best[partner[ok]] + xp[ok] > floor
+        ok &= (
+            left_counts[start : start + rows, None, :] + right_counts[None, :, :]
+        ).max(axis=2, initial=0) <= n
+        li, ri = np.nonzero(ok)
+        kept.append(
+            (
+                (li + start).astype(np.int32),
+                ri.astype(np.int32),
+                cost[li, ri].astype(np.int32),
+                xp[li, ri],
+            )
+        )
+
+    if not kept:
+        empty = np.empty(0, dtype=np.int32)
+        return empty, empty, empty, np.empty(0)
+
+    li, ri, cost, xp = (np.concatenate(column) for column in zip(*kept))
+    order = np.argsort(cost, kind="stable")
+    return li[order], ri[order], cost[order], xp[order]
+
+
+def _pareto(
+    table: structures.PlayerTable,
+    combinations: np.ndarray,
+    top: int = 1,
+) -> np.ndarray:
+
+    # A combination is dominated when another one with exactly the same team
+    # makeup costs no more and scores no less xP (and is strictly better in one
+    # of the two), swapping it in can then never break a team constraint. With
+    # top-K a combination is only dropped when K others dominate it.
+    if not len(combinations):
+        return combinations
+
+    cost, xp = _sums(table, combinations)
+    xp = np.round(xp, 1)
+    _, group = np.unique(
+        np.sort(table.team[combinations], axis=1), axis=0, return_inverse=True
+    )
+    group = group.reshape(-1)
+    order = np.lexsort((-xp, cost, group))
+
+    if top == 1:
+        # In that order a combination is dominated when one before it in its
+        # group costs less and scores no less, or when the first one of its
+        # cost scores more. Per group running maxima of xP, in tenths offset
+        # by the group, find both without a loop.
+        tenths = np.round(xp[order] * 10).astype(np.int64)
+        tenths = group[order] * (np.ptp(tenths) + 1) + tenths - tenths.min()
+        running = np.maximum.accumulate(tenths)
+        change = np.ones(len(order), dtype=bool)
+        change[1:] = (np.diff(group[order]) != 0) | (np.diff(cost[order]) != 0)
+        first = np.flatnonzero(change)[np.cumsum(change) - 1]
+        dominated = tenths[first] > tenths
+        dominated[first > 0] |= running[first[first > 0] - 1] >= tenths[first > 0]
+        return combinations[np.sort(order[~dominated])]
+
+    # Only the K best xP of the cheaper combinations can decide whether one
+    # is dominated K times, so no more of them are kept.
+    keep = np.zeros(len(combinations), dtype=bool)
+    rows = zip(group[order].tolist(), cost[order].tolist(), order.tolist())
+    for _, same_group in itertools.groupby(rows, key=lambda x: x[0]):
+        cheaper: T.List[float] = []
+        for _, same_cost in itertools.groupby(same_group, key=lambda x: x[1]):
+            idxs = [idx for *_, idx in same_cost]
+            xps = sorted(xp[idxs].tolist())
+            for idx, value in zip(idxs, xp[idxs].tolist()):
+                dominators = (
+                    len(cheaper)
+                    - bisect.bisect_left(cheaper, value)
+                    + len(xps)
+                    - bisect.bisect_right(xps, value)
+                )
+                if dominators < top:
+                    keep[idx] = True
+            cheaper = list(heapq.merge(cheaper, xps))[-top:]
+
+    return combinations[keep]
+
+
+def _tiebreak(
+    lineup: T.Sequence[structures.Player],
+) -> T.Tuple[float, T.Tuple[str, ...]]:
+    return functions.lineup_xp(lineup), tuple(sorted(p.name for p in lineup))
+
+
+class _TopK:
+
+    # Bounded min-heap of the K best lineups, the worst kept lineup on top.
+
+    def __init__(self, k: int):
+        self.k = k
+        self.heap: T.List[
+            T.Tuple[T.Tuple[float, T.Tuple[str, ...]], T.Tuple[structures.Player, ...]]
+        ] = []
+        self.keys: T.Set[T.Tuple[float, T.Tuple[str, ...]]] = set()
+
+    def full(self) -> bool:
+        return len(self.heap) >= self.k
+
+    def threshold(self, default: float) -> float:
+        if self.full():
+            return self.heap[0][0][0]
+        return default
+
+    def push(self, lineup: T.Sequence[structures.Player]) -> bool:
+        item = (_tiebreak(lineup), tuple(lineup))
+        if item[0] in self.keys:
+            return False
+        if not self.full():
+            heapq.heappush(self.heap, item)
+        elif item[0] > self.heap[0][0]:
+            self.keys.discard(heapq.heapreplace(self.heap, item)[0])
+        else:
+            return False
+        self.keys.add(item[0])
+        return True
+
+    def lineups(self) -> T.List[T.List[structures.Player]]:
+        return [
+            list(lineup)
+            for _, lineup in sorted(self.heap, key=lambda x: x[0], reverse=True)
+        ]
+
+
+def _warm_start(
+    pool: T.Sequence[structures.Player],
+    buget: int,
+    must: T.Set[str],
+    squad: T.Tuple[T.Tuple[T.Literal["GKP", "DEF", "MID", "FWD"], int, int], ...] = (
+        ("GKP", 2, 1),
+        ("DEF", 5, 1),
+        ("MID", 5, 2),
+        ("FWD", 3, 1),
+    ),
+) -> T.Optional[T.List[structures.Player]]:
+
+    # Greedy feasible lineup, used as incumbent so the exact search runs a
+    # single pass. Picks by xP while keeping enough budget for the cheapest
+    # way to fill the open slots, then repairs the budget and improves with
+    # single swaps.
+
+    need: T.Dict[str, int] = {pos: n for pos, n, _ in squad}
+    cheapest = {
+        pos: sorted(p.cost for p in pool if p.position == pos) for pos in need
+    }
+
+    def valid(lineup: T.Sequence[structures.Player]) -> bool:
+        if not lineup:
+            return True
+        return (
+            all(
+                sum(1 for p in lineup if p.position == pos) <= n
+                for pos, n in need.items()
+            )
+            and constraints.team_constraint(lineup)
+            and constraints.gkp_def_not_same_team(lineup)
+            and all(
+                constraints.position_constraint(lineup, limit, pos)
+                for pos, _, limit in squad
+                if any(p.position == pos for p in lineup)
+            )
+        )
+
+    def reserve(lineup: T.Sequence[structures.Player]) -> int:
+        return sum(
+            sum(cheapest[pos][: n - sum(1 for p in lineup if p.position == pos)])
+            for pos, n in need.items()
+        )
+
+    def swaps(lineup: T.List[structures.Player]):
+        for idx, out in enumerate(lineup):
+            if out.name in must:
+                continue
+            for p in pool:
+                if p.position == out.position and p not in lineup:
+                    yield idx, out, p
+
+    def greedy(price: float) -> T.Optional[T.List[structures.Player]]:
+        lineup = [p for p in pool if p.name in must]
+        if not valid(lineup):
+            return None
+
+        for p in sorted(pool, key=lambda p: p.xP - price * p.cost, reverse=True):
+            if (
+                p not in lineup
+                and valid(lineup + [p])
+                and functions.lineup_cost(lineup) + p.cost + reserve(lineup + [p])
+                <= buget
+            ):
+                lineup.append(p)
+
+        for p in sorted(pool, key=lambda p: p.cost):
+            if p not in lineup and valid(lineup + [p]):
+                lineup.append(p)
+
+        if len(lineup) != sum(need.values()):
+            return None
+
+        # Repair: cheapest xP loss per cost saved until the budget holds.
+        while functions.lineup_cost(lineup) > buget:
+            options = [
+                ((out.xP - p.xP) / (out.cost - p.cost), idx, p)
+                for idx, out, p in swaps(lineup)
+                if p.cost < out.cost
+                and valid(lineup[:idx] + [p] + lineup[idx + 1 :])
+            ]
+            if not options:
+                return None
+            _, idx, p = min(options, key=lambda x: x[0])
+            lineup[idx] = p
+
+        # Improve: best single swap until none gains xP.
+        while True:
+            options = [
+                (p.xP - out.xP, idx, p)
+                for idx, out, p in swaps(lineup)
+                if p.xP > out.xP
+                and functions.lineup_cost(lineup) - out.cost + p.cost <= buget
+                and valid(lineup[:idx] + [p] + lineup[idx + 1 :])
+            ]
+            if not options:
+                break
+            _, idx, p = max(options, key=lambda x: x[0])
+            lineup[idx] = p
+
+        return lineup
+
+    # Greedy on xP alone overspends early, so also rank by xP minus a price
+    # per unit of cost and keep the best of a small grid of prices.
+    top_ratio = max((p.xP / p.cost for p in pool if p.cost > 0), default=0.0)
+    candidates = [greedy(top_ratio * step / 8) for step in range(9)]
+    return max(
+        (c for c in candidates if c),
+        key=functions.lineup_xp,
+        default=None,
+    )
+
+
+def _report(
+    incumbent: T.Optional[T.List[structures.Player]],
+    best: T.List[T.List[structures.Player]],
+) -> T.List[T.List[structures.Player]]:
+    if incumbent and best:
+        start = functions.lineup_xp(incumbent)
+        end = functions.lineup_xp(best[0])
+        print(
+            f"Incumbent xP:            {start} "
+            f"(gap to optimum: {round(end - start, 1)}, "
+            f"{100 * (end - start) / end if end else 0:.1f}%)"
+        )
+    return best
+
+
 def lineup(
     pool: T.List[structures.Player],
     buget=1_000,
@@ -26,21 +447,59 @@ def lineup(
         (),
         (),
     ),
+    solver: T.Literal["nested", "mitm", "bnb", "parallel"] = "nested",
+    workers: T.Optional[int] = None,
 ) -> T.List[structures.Player]:
+    best = lineups(
+        pool=pool,
+        buget=buget,
+        ignore=ignore,
+        base=base,
+        solver=solver,
+        workers=workers,
+        top=1,
+    )
+    return best[0] if best else []
 
-    pool = [p for p in pool if p.name not in ignore]
 
-    _gkp = sorted(
-        (p for p in pool if p.position == "GKP"), key=lambda p: p.xP, reverse=True
-    )
-    _def = sorted(
-        (p for p in pool if p.position == "DEF"), key=lambda p: p.xP, reverse=True
-    )
-    _mid = sorted(
-        (p for p in pool if p.position == "MID"), key=lambda p: p.xP, reverse=True
+def lineups(
+    pool: T.Union[T.List[structures.Player], structures.PlayerTable],
+    buget=1_000,
+    ignore: T.Tuple[str, ...] = tuple(),
+    base=(
+        (),
+        (),
+        (),
+        (),
+    ),
+    solver: T.Literal["nested", "mitm", "bnb", "parallel"] = "nested",
+    workers: T.Optional[int] = None,
+    top: int = 10,
+) -> T.List[T.List[structures.Player]]:
+
+    if top <= 0:
+        raise ValueError(f"top must be positive, got {top}.")
+
+    # The pool is filtered and sorted as a table: by position, then by xP
+    # descending. The sorts are stable, so ties keep their pool order.
+    table = (
+        pool
+        if isinstance(pool, structures.PlayerTable)
+        else structures.PlayerTable.from_players(pool)
     )
-    _fwd = sorted(
-        (p for p in pool if p.position == "FWD"), key=lambda p: p.xP, reverse=True
+    ignored = np.isin(table.name, list(ignore))
+    rows = []
+    for position in gather.positions():
+        idx = np.flatnonzero((table.position == table.code(position)) & ~ignored)
+        rows.append(idx[np.argsort(-table.xP[idx], kind="stable")])
+    table = table[np.concatenate(rows)]
+    offsets = list(itertools.accumulate(len(r) for r in rows))
+
+    # Combinations are index arrays into the table, Player tuples are only
+    # built for what the solvers below need.
+    players = table.players()
+    _gkp, _def, _mid, _fwd = (
+        players[start:stop] for start, stop in zip([0] + offsets, offsets)
     )
 
     m_gkps, m_defs, m_mids, m_fwds = tuple(set(m) for m in base)
@@ -61,46 +520,42 @@ def lineup(
         if m_fwd not in set(f.name for f in _fwd):
             print(f"Unkown forwarder {m_fwd}")
 
-    def _gkp_combinations():
-        yield from filter(
-            lambda g: constraints.position_constraint(g, 1, "GKP")
-            and constraints.must_contain(g, m_gkps),
-            itertools.combinations(_gkp, 2),
-        )
+    incumbent = _warm_start(
+        pool=players,
+        buget=buget,
+        must=m_gkps | m_defs | m_mids | m_fwds,
+    )
 
-    def _def_combinations():
-        yield from filter(
-            lambda d: constraints.position_constraint(d, 1, "DEF")
-            and constraints.must_contain(d, m_defs),
-            itertools.combinations(_def, 5),
-        )
+    if settings.Global.verbose and incumbent:
+        print("Incumbent:")
+        functions.sprint(incumbent)
 
-    def _mid_combinations():
-        yield from filter(
-            lambda m: constraints.position_constraint(m, 2, "MID")
-            and constraints.must_contain(m, m_mids),
-            itertools.combinations(_mid, 5),
+    if solver == "bnb":
+        return _report(
+            incumbent,
+            _bnb(
+                pool=players,
+                buget=buget,
+                must=m_gkps | m_defs | m_mids | m_fwds,
+                top=top,
+                incumbent=incumbent,
+            ),
         )
 
-    def _fwd_combinations():
-        yield from filter(
-            lambda f: constraints.position_constraint(f, 1, "FWD")
-            and constraints.must_contain(f, m_fwds),
-            itertools.combinations(_fwd, 3),
+    def frontier(
+        position: int, k: int, n: int, must: T.Set[str]
+    ) -> T.Tuple[np.ndarray, int]:
+        start = offsets[position - 1] if position else 0
+        kept, count = _combinations(
+            table, range(start, offsets[position]), k, n, must, top
         )
+        _, xp = _sums(table, kept)
+        return kept[np.argsort(-np.round(xp, 1), kind="stable")], count
 
-    gkp_combinations = tuple(
-        sorted(_gkp_combinations(), key=functions.lineup_xp, reverse=True)
-    )
-    def_combinations = tuple(
-        sorted(_def_combinations(), key=functions.lineup_xp, reverse=True)
-    )
-    mid_combinations = tuple(
-        sorted(_mid_combinations(), key=functions.lineup_xp, reverse=True)
-    )
-    fwd_combinations = tuple(
-        sorted(_fwd_combinations(), key=functions.lineup_xp, reverse=True)
-    )
+    gkp_combinations, gkp_candidates = frontier(0, 2, 1, m_gkps)
+    def_combinations, def_candidates = frontier(1, 5, 1, m_defs)
+    mid_combinations, mid_candidates = frontier(2, 5, 2, m_mids)
+    fwd_combinations, fwd_candidates = frontier(3, 3, 1, m_fwds)
 
     total = (
         len(gkp_combinations)
@@ -109,105 +564,709 @@ def lineup(
         * len(fwd_combinations)
     )
 
-    print(f"Goalkeeper combinations: {len(gkp_combinations)}")
-    print(f"Defender combinations:   {len(def_combinations)}")
-    print(f"Midfielder combinations: {len(mid_combinations)}")
-    print(f"Forwarder combinations:  {len(fwd_combinations)}")
+    print(
+        f"Goalkeeper combinations: {len(gkp_combinations)} "
+        f"(dominated: {gkp_candidates - len(gkp_combinations)})"
+    )
+    print(
+        f"Defender combinations:   {len(def_combinations)} "
+        f"(dominated: {def_candidates - len(def_combinations)})"
+    )
+    print(
+        f"Midfielder combinations: {len(mid_combinations)} "
+        f"(dominated: {mid_candidates - len(mid_combinations)})"
+    )
+    print(
+        f"Forwarder combinations:  {len(fwd_combinations)} "
+        f"(dominated: {fwd_candidates - len(fwd_combinations)})"
+    )
     print(f"Total combinations:      {total:.1e}")
 
     if not total:
         return []
 
-    min_cost_mid = functions.lineup_cost(
-        min(mid_combinations, key=functions.lineup_cost)
-    )
-    min_cost_fwd = functions.lineup_cost(
-        min(fwd_combinations, key=functions.lineup_cost)
-    )
+    if solver == "mitm":
+        return _report(
+            incumbent,
+            _mitm(
+                table=table,
+                players=players,
+                gkp_combinations=gkp_combinations,
+                def_combinations=def_combinations,
+                mid_combinations=mid_combinations,
+                fwd_combinations=fwd_combinations,
+                buget=buget,
+                top=top,
+                incumbent=incumbent,
+            ),
+        )
 
-    max_cost_mid = functions.lineup_cost(
-        max(mid_combinations, key=functions.lineup_cost)
-    )
-    max_cost_fwd = functions.lineup_cost(
-        max(fwd_combinations, key=functions.lineup_cost)
+    gkp_tuples, def_tuples, mid_tuples, fwd_tuples = (
+        tuple(tuple(players[i] for i in c) for c in combinations.tolist())
+        for combinations in (
+            gkp_combinations,
+            def_combinations,
+            mid_combinations,
+            fwd_combinations,
+        )
     )
 
-    max_xp_gkp = functions.lineup_xp(max(gkp_combinations, key=functions.lineup_xp))
-    max_xp_def = functions.lineup_xp(max(def_combinations, key=functions.lineup_xp))
-    max_xp_mid = functions.lineup_xp(max(mid_combinations, key=functions.lineup_xp))
-    max_xp_fwd = functions.lineup_xp(max(fwd_combinations, key=functions.lineup_xp))
+    min_cost_mid = functions.lineup_cost(min(mid_tuples, key=functions.lineup_cost))
+    min_cost_fwd = functions.lineup_cost(min(fwd_tuples, key=functions.lineup_cost))
+
+    max_xp_mid = functions.lineup_xp(max(mid_tuples, key=functions.lineup_xp))
+    max_xp_fwd = functions.lineup_xp(max(fwd_tuples, key=functions.lineup_xp))
 
     min_cost_mid_fwd = min_cost_mid + min_cost_fwd
-    max_cost_mid_fwd = max_cost_mid + max_cost_fwd
     max_xp_mid_fwd = max_xp_mid + max_xp_fwd
 
-    best_lineup: T.List[structures.Player] = []
-    buget_lower = buget * 0.95
-    best_xp = sum((max_xp_gkp, max_xp_def, max_xp_mid, max_xp_fwd))
-    step = len(mid_combinations) * len(fwd_combinations)
+    step = len(mid_tuples) * len(fwd_tuples)
 
     if settings.Global.verbose:
         print(f"{min_cost_mid=}, {min_cost_fwd=}, {min_cost_mid_fwd=}")
         print(f"{max_xp_mid=}, {max_xp_fwd=}, {max_xp_mid_fwd=}")
         print(f"{m_gkps=}, {m_defs=}, {m_mids=}, {m_fwds=}")
 
-    def lvl1(c):
+    bounds = _Bounds(
+        buget=buget,
+        min_cost_fwd=min_cost_fwd,
+        min_cost_mid_fwd=min_cost_mid_fwd,
+        max_xp_fwd=max_xp_fwd,
+        max_xp_mid_fwd=max_xp_mid_fwd,
+    )
+
+    if solver == "parallel":
+        return _report(
+            incumbent,
+            _parallel(
+                gkp_combinations=gkp_tuples,
+                def_combinations=def_tuples,
+                mid_combinations=mid_tuples,
+                fwd_combinations=fwd_tuples,
+                bounds=bounds,
+                workers=workers,
+                top=top,
+                incumbent=incumbent,
+            ),
+        )
+
+    found = _TopK(top)
+    if incumbent:
+        found.push(incumbent)
+    best_xp = float("-inf")
+
+    with tqdm(
+        total=total,
+        bar_format="{percentage:3.0f}%|{bar:20}{r_bar}",
+        unit_scale=True,
+        unit_divisor=2 ** 10,
+    ) as bar:
+        for g in gkp_tuples:
+            for d in def_tuples:
+                bar.update(step)
+                g1 = g + d
+                if bounds.lvl1(g1, found.threshold(best_xp)):
+                    for m in mid_tuples:
+                        g2 = g1 + m
+                        if bounds.lvl2(g2, found.threshold(best_xp)):
+                            for f in fwd_tuples:
+                                g3 = g2 + f
+                                if bounds.lvl3(
+                                    g3, found.threshold(best_xp)
+                                ) and found.push(g3):
+                                    if settings.Global.verbose:
+                                        print("-" * 100)
+                                        functions.sprint(list(g3))
+
+    return _report(incumbent, found.lineups())
+
+
+# Per-process state of the parallel search, set once by _shard_init so the
+# combinations are not pickled with every shard.
+_shard_state: T.Dict[str, T.Any] = {}
+
+
+def _shard_init(
+    gkp_combinations,
+    def_combinations,
+    mid_combinations,
+    fwd_combinations,
+    bounds: _Bounds,
+    shared,
+    top: int,
+) -> None:
+    _shard_state.update(
+        gkp_combinations=gkp_combinations,
+        def_combinations=def_combinations,
+        mid_combinations=mid_combinations,
+        fwd_combinations=fwd_combinations,
+        bounds=bounds,
+        shared=shared,
+        top=top,
+    )
+
+
+def _shard(
+    task: T.Tuple[int, int, int],
+) -> T.Tuple[int, T.List[T.List[structures.Player]]]:
+
+    gidx, start, stop = task
+    g = _shard_state["gkp_combinations"][gidx]
+    mid_combinations = _shard_state["mid_combinations"]
+    fwd_combinations = _shard_state["fwd_combinations"]
+    bounds: _Bounds = _shard_state["bounds"]
+    shared = _shard_state["shared"]
+    found = _TopK(_shard_state["top"])
+
+    def best_xp() -> float:
+        # Ties must survive pruning, otherwise which of two equal lineups is
+        # returned would depend on how the shards were scheduled.
+        return shared.value - 1e-6
+
+    for d in _shard_state["def_combinations"][start:stop]:
+        g1 = g + d
+        if bounds.lvl1(g1, best_xp()):
+            for m in mid_combinations:
+                g2 = g1 + m
+                if bounds.lvl2(g2, best_xp()):
+                    for f in fwd_combinations:
+                        g3 = g2 + f
+                        if (
+                            bounds.lvl3(g3, best_xp())
+                            and found.push(g3)
+                            and found.full()
+                        ):
+                            # The K-th best of any single shard is a lower
+                            # bound for the global K-th best.
+                            with shared.get_lock():
+                                shared.value = max(
+                                    shared.value, found.threshold(shared.value)
+                                )
+
+    return stop - start, found.lineups()
+
+
+def _parallel(
+    gkp_combinations: T.Sequence[T.Tuple[structures.Player, ...]],
+    def_combinations: T.Sequence[T.Tuple[structures.Player, ...]],
+    mid_combinations: T.Sequence[T.Tuple[structures.Player, ...]],
+    fwd_combinations: T.Sequence[T.Tuple[structures.Player, ...]],
+    bounds: _Bounds,
+    workers: T.Optional[int],
+    top: int,
+    incumbent: T.Optional[T.List[structures.Player]],
+) -> T.List[T.List[structures.Player]]:
+
+    workers = workers or os.cpu_count() or 1
+    chunk = max(1, len(def_combinations) // (workers * 4))
+    tasks = [
+        (gidx, start, min(start + chunk, len(def_combinations)))
+        for gidx in range(len(gkp_combinations))
+        for start in range(0, len(def_combinations), chunk)
+    ]
+    step = len(mid_combinations) * len(fwd_combinations)
+    total = len(gkp_combinations) * len(def_combinations) * step
+
+    print(f"Workers:                 {workers}")
+    print(f"Shards:                  {len(tasks)}")
+
+    found = _TopK(top)
+    if incumbent:
+        found.push(incumbent)
+    shared = multiprocessing.Value("d", found.threshold(float("-inf")))
+
+    with concurrent.futures.ProcessPoolExecutor(
+        workers,
+        initializer=_shard_init,
+        initargs=(
+            gkp_combinations,
+            def_combinations,
+            mid_combinations,
+            fwd_combinations,
+            bounds,
+            shared,
+            top,
+        ),
+    ) as wp, tqdm(
+        total=total,
+        bar_format="{percentage:3.0f}%|{bar:20}{r_bar}",
+        unit_scale=True,
+        unit_divisor=2 ** 10,
+    ) as bar:
+        for future in concurrent.futures.as_completed(
+            [wp.submit(_shard, task) for task in tasks]
+        ):
+            done, shard_lineups = future.result()
+            bar.update(done * step)
+            for shard_lineup in shard_lineups:
+                if found.push(shard_lineup) and settings.Global.verbose:
+                    print("-" * 100)
+                    functions.sprint(shard_lineup)
+
+    return found.lineups()
+
+
+def _mitm(
+    table: structures.PlayerTable,
+    players: T.Sequence[structures.Player],
+    gkp_combinations: np.ndarray,
+    def_combinations: np.ndarray,
+    mid_combinations: np.ndarray,
+    fwd_combinations: np.ndarray,
+    buget: int,
+    top: int,
+    incumbent: T.Optional[T.List[structures.Player]],
+) -> T.List[T.List[structures.Player]]:
+
+    # Meet-in-the-middle: GKP+DEF on the left, MID+FWD on the right. The right
+    # half is sorted by cost with a running max of xP, so the best affordable
+    # right half for any left half is a binary search away. Halves are pairs
+    # of rows in the combination arrays. Only the pair indexes, costs and xP
+    # of the right halves are stored, their team counts are summed for the
+    # candidates being checked.
+    gkp_cost, gkp_xp = _sums(table, gkp_combinations)
+    def_cost, def_xp = _sums(table, def_combinations)
+    gkp_counts = _counts(table, gkp_combinations)
+    def_counts = _counts(table, def_combinations)
+    mid_counts = _counts(table, mid_combinations)
+    fwd_counts = _counts(table, fwd_combinations)
+
+    gi, di = np.nonzero(_compatible(gkp_counts, def_counts, disjoint=True))
+    if not len(gi):
+        return []
+    left_xp = np.round(gkp_xp[gi] + def_xp[di], 1)
+    remaining = buget - (gkp_cost[gi] + def_cost[di])
+
+    # A right half no left half can afford is never used. With one lineup
+    # wanted, neither is one that cannot beat the incumbent, less a margin
+    # for rounding, with the best left half it can afford. That keeps the
+    # right halves few on large pools.
+    floor = float("-inf")
+    if incumbent and top == 1:
+        floor = functions.lineup_xp(incumbent) - 0.1
+    mi, fi, right_cost, right_xp = _pairs(
+        table,
+        mid_combinations,
+        fwd_combinations,
+        partner_cost=buget - remaining,
+        partner_xp=left_xp,
+        buget=buget,
+        floor=floor,
+    )
+
+    if not len(mi):
+        return []
+
+    # Index of the first right half holding the best xP so far.
+    best_so_far = np.maximum.accumulate(right_xp)
+    new_best = np.ones(len(right_xp), dtype=bool)
+    new_best[1:] = best_so_far[1:] > best_so_far[:-1]
+    running_max = np.maximum.accumulate(
+        np.where(new_best, np.arange(len(mi), dtype=np.int32), 0)
+    )
+
+    # Fallback order when the best affordable right half clashes with the
+    # left half on the team constraint, or when more than one is wanted.
+    right_by_xp = np.argsort(-right_xp, kind="stable")
+
+    idx = np.searchsorted(right_cost, remaining, side="right") - 1
+    affordable = idx >= 0
+    gi, di, left_xp, remaining, idx = (
+        a[affordable] for a in (gi, di, left_xp, remaining, idx)
+    )
+    bound = left_xp + right_xp[running_max[idx]]
+    order = np.argsort(-bound, kind="stable")
+
+    print(f"Left half (GKP+DEF):       {len(order)}")
+    print(f"Right half (MID+FWD):      {len(mi)}")
+
+    found = _TopK(top)
+    if incumbent:
+        found.push(incumbent)
+
+    def lineup(left: int, right: int) -> T.Tuple[structures.Player, ...]:
+        return tuple(
+            players[i]
+            for i in itertools.chain(
+                gkp_combinations[gi[left]],
+                def_combinations[di[left]],
+                mid_combinations[mi[right]],
+                fwd_combinations[fi[right]],
+            )
+        )
+
+    def push(g3) -> bool:
+        pushed = found.push(g3)
+        if pushed and settings.Global.verbose:
+            print("-" * 100)
+            functions.sprint(g3)
+        return pushed
+
+    for left in tqdm(
+        order.tolist(),
+        bar_format="{percentage:3.0f}%|{bar:20}{r_bar}",
+    ):
+        if bound[left] <= found.threshold(float("-inf")):
+            break
+
+        counts = gkp_counts[gi[left]] + def_counts[di[left]]
+        best = running_max[idx[left]]
+        if (counts + mid_counts[mi[best]] + fwd_counts[fi[best]]).max() <= 2:
+            push(lineup(left, best))
+            if top == 1:
+                continue
+
+        # Right halves in xP order, feasibility is checked a growing block at
+        # a time. Once one of them cannot beat the threshold no later one can.
+        start, size, done = 0, 64, False
+        while start < len(right_by_xp) and not done:
+            block = right_by_xp[start : start + size]
+            start, size = start + size, size * 2
+            if left_xp[left] + right_xp[block[0]] <= found.threshold(float("-inf")):
+                break
+            feasible = block[
+                (block != best)
+                & (right_cost[block] <= remaining[left])
+                & (
+                    (counts + mid_counts[mi[block]] + fwd_counts[fi[block]]).max(
+                        axis=1
+                    )
+                    <= 2
+                )
+            ]
+            for ridx in feasible.tolist():
+                if left_xp[left] + right_xp[ridx] <= found.threshold(float("-inf")):
+                    done = True
+                    break
+                if push(lineup(left, ridx)) and top == 1:
+                    done = True
+                    break
+
+    return found.lineups()
+
+
+def _bnb(
+    pool: T.List[structures.Player],
+    buget: int,
+    must: T.Set[str],
+    top: int,
+    incumbent: T.Optional[T.List[structures.Player]],
+    squad: T.Tuple[T.Tuple[T.Literal["GKP", "DEF", "MID", "FWD"], int, int], ...] = (
+        ("GKP", 2, 1),
+        ("DEF", 5, 1),
+        ("MID", 5, 2),
+        ("FWD", 3, 1),
+    ),
+    team_limit: int = 2,
+) -> T.List[T.List[structures.Player]]:
+
+    # Exact branch-and-bound over individual players. Bounds come from a
+    # Lagrangian relaxation: position counts and per-position team caps are
+    # kept (a partition matroid, solved greedily), while the budget, the team
+    # cap and gkp_def_not_same_team are priced into a reduced score. The
+    # multipliers are optimized once at the root by subgradient descent and
+    # reused at every node, where the bound stays valid for any multipliers.
+
+    need: T.Dict[str, int] = {pos: n for pos, n, _ in squad}
+    position_limit: T.Dict[str, int] = {pos: n for pos, _, n in squad}
+
+    fixed = [p for p in pool if p.name in must]
+    free = [p for p in pool if p.name not in must and p.position in need]
+
+    for p in fixed:
+        need[p.position] -= 1
+
+    if (
+        any(n < 0 for n in need.values())
+        or functions.lineup_cost(fixed) > buget
+        or (fixed and not constraints.team_constraint(fixed, n=team_limit))
+        or not constraints.gkp_def_not_same_team(fixed)
+        or not all(
+            constraints.position_constraint(fixed, limit, pos)
+            for pos, _, limit in squad
+            if any(p.position == pos for p in fixed)
+        )
+    ):
+        return []
+
+    positions = tuple(need)
+    teams = set(p.team for p in pool)
+
+    team_count = C.Counter(p.team for p in fixed)
+    position_team_count = C.Counter((p.position, p.team) for p in fixed)
+    gkp_teams = C.Counter(p.team for p in fixed if p.position == "GKP")
+    def_teams = C.Counter(p.team for p in fixed if p.position == "DEF")
+
+    def feasible(p: structures.Player) -> bool:
         return (
-            buget_lower - max_cost_mid_fwd
-            <= functions.lineup_cost(c)
-            <= buget - min_cost_mid_fwd
-            and functions.lineup_xp(c) + max_xp_mid_fwd > best_xp
-            and constraints.team_constraint(c)
-            and constraints.gkp_def_not_same_team(c)
+            need[p.position] > 0
+            and team_count[p.team] < team_limit
+            and position_team_count[(p.position, p.team)] < position_limit[p.position]
+            and not (p.position == "GKP" and def_teams[p.team])
+            and not (p.position == "DEF" and gkp_teams[p.team])
         )
 
-    def lvl2(c):
+    def greedy(
+        candidates: T.Dict[str, T.Iterable[structures.Player]],
+        score: T.Callable[[structures.Player], float],
+    ) -> T.Tuple[float, T.List[structures.Player]]:
+        # Best completion under position counts and team caps applied within
+        # each position, candidates must be ordered by score.
+        total = 0.0
+        chosen: T.List[structures.Player] = []
+        for pos in positions:
+            n = need[pos]
+            taken: T.Counter[str] = C.Counter()
+            for p in candidates[pos]:
+                if not n:
+                    break
+                if (
+                    feasible(p)
+                    and taken[p.team] + team_count[p.team] < team_limit
+                    and taken[p.team] + position_team_count[(pos, p.team)]
+                    < position_limit[pos]
+                ):
+                    taken[p.team] += 1
+                    total += score(p)
+                    chosen.append(p)
+                    n -= 1
+            if n:
+                return float("-inf"), []
+        return total, chosen
+
+    lam = 0.0
+    mu = {t: 0.0 for t in teams}
+    nu = {t: 0.0 for t in teams}
+
+    def reduced(p: structures.Player) -> float:
         return (
-            buget_lower - max_cost_fwd
-            <= functions.lineup_cost(c)
-            <= buget - min_cost_fwd
-            and functions.lineup_xp(c) + max_xp_fwd > best_xp
-            and constraints.team_constraint(c)
+            p.xP
+            - lam * p.cost
+            - mu[p.team]
+            - (nu[p.team] if p.position in ("GKP", "DEF") else 0.0)
         )
 
-    def lvl3(c):
+    def dual() -> T.Tuple[float, T.List[structures.Player]]:
+        ordered = sorted(free, key=reduced, reverse=True)
+        value, chosen = greedy(
+            {pos: [p for p in ordered if p.position == pos] for pos in positions},
+            reduced,
+        )
         return (
-            functions.lineup_cost(c) <= buget
-            and functions.lineup_xp(c) > best_xp
-            and constraints.team_constraint(c)
+            value
+            + sum(reduced(p) for p in fixed)
+            + lam * buget
+            + sum(mu.values()) * team_limit
+            + sum(nu.values())
+        ), chosen
+
+    # Budget price first, golden-section on the convex piecewise linear dual.
+    lo, hi = 0.0, max(p.xP / p.cost for p in free if p.cost > 0) if free else 0.0
+    ratio = (5**0.5 - 1) / 2
+    for _ in range(64):
+        a, b = hi - ratio * (hi - lo), lo + ratio * (hi - lo)
+        lam = a
+        value_a, _ = dual()
+        lam = b
+        value_b, _ = dual()
+        if value_a <= value_b:
+            hi = b
+        else:
+            lo = a
+    lam = (lo + hi) / 2
+
+    best_dual, chosen = dual()
+    if best_dual == float("-inf"):
+        return []
+
+    # Then all multipliers together with Polyak-style subgradient steps, the
+    # budget row is scaled to the price of an average squad slot.
+    scale = buget / sum(need.values()) if any(need.values()) else 1.0
+    best_multipliers = (lam, dict(mu), dict(nu))
+    value, theta, stale = best_dual, 1.0, 0
+    for _ in range(200):
+        relaxed = fixed + chosen
+        g_lam = (buget - functions.lineup_cost(relaxed)) / scale
+        count = C.Counter(p.team for p in relaxed)
+        gkp_def = C.Counter(p.team for p in relaxed if p.position in ("GKP", "DEF"))
+        g_mu = {t: team_limit - count[t] for t in teams}
+        g_nu = {t: 1 - gkp_def[t] for t in teams}
+
+        norm = (
+            g_lam**2
+            + sum(v * v for v in g_mu.values())
+            + sum(v * v for v in g_nu.values())
         )
+        if not norm:
+            break
 
-    while not best_lineup:
-
-        best_xp = best_xp * 0.95
-
-        if settings.Global.verbose:
-            print(f"best_xp={best_xp}")
-
-        with tqdm(
-            total=total,
-            bar_format="{percentage:3.0f}%|{bar:20}{r_bar}",
-            unit_scale=True,
-            unit_divisor=2 ** 10,
-        ) as bar:
-            for g in gkp_combinations:
-                for d in def_combinations:
-                    bar.update(step)
-                    g1 = g + d
-                    if lvl1(g1):
-                        for m in mid_combinations:
-                            g2 = g1 + m
-                            if lvl2(g2):
-                                for f in fwd_combinations:
-                                    g3 = g2 + f
-                                    if lvl3(g3):
-                                        best_xp = functions.lineup_xp(g3)
-                                        best_lineup = g3
-                                        if settings.Global.verbose:
-                                            print("-" * 100)
-                                            functions.sprint(g3)
+        step = theta * 0.05 * abs(value) / norm
+        lam = max(0.0, lam - step * g_lam / scale)
+        mu = {t: max(0.0, mu[t] - step * g_mu[t]) for t in teams}
+        nu = {t: max(0.0, nu[t] - step * g_nu[t]) for t in teams}
 
-    return best_lineup
+        value, chosen = dual()
+        if value < best_dual - 1e-9:
+            best_dual, stale = value, 0
+            best_multipliers = (lam, dict(mu), dict(nu))
+        else:
+            stale += 1
+            if stale >= 5:
+                theta, stale = theta / 2, 0
+
+    lam, mu, nu = best_multipliers
+
+    order = sorted(free, key=reduced, reverse=True)
+    by_position = {pos: [p for p in order if p.position == pos] for pos in positions}
+
+    # prefix[pos][k]: sum of the k best reduced scores of that position,
+    # before[pos][i]: how many players of that position come before order[i].
+    prefix: T.Dict[str, T.List[float]] = {pos: [0.0] for pos in positions}
+    before: T.Dict[str, T.List[int]] = {pos: [] for pos in positions}
+    for player in order:
+        for pos in positions:
+            before[pos].append(len(prefix[pos]) - 1)
+        prefix[player.position].append(prefix[player.position][-1] + reduced(player))
+    for pos in positions:
+        before[pos].append(len(prefix[pos]) - 1)
+
+    def bound(i: int, acc: float) -> float:
+        for pos in positions:
+            k = before[pos][i]
+            n = need[pos]
+            if k + n >= len(prefix[pos]):
+                return float("-inf")
+            acc += prefix[pos][k + n] - prefix[pos][k]
+        return acc
+
+    def team_bound(i: int, acc: float) -> float:
+        value, _ = greedy(
+            {
+                pos: itertools.islice(by_position[pos], before[pos][i], None)
+                for pos in positions
+            },
+            reduced,
+        )
+        return acc + value
+
+    found = _TopK(top)
+    if incumbent:
+        found.push(incumbent)
+    nodes = 0
+
+    def branch(
+        i: int,
+        picked: T.List[structures.Player],
+        cost: int,
+        xp: float,
+        acc: float,
+    ):
+        nonlocal nodes
+
+        nodes += 1
+        best_xp = found.threshold(float("-inf"))
+
+        if not any(need.values()):
+            if xp > best_xp + 1e-9 and found.push(fixed + picked):
+                if settings.Global.verbose:
+                    print("-" * 100)
+                    functions.sprint(fixed + picked)
+            return
+
+        if team_bound(i, acc) <= best_xp + 1e-9:
+            return
+
+        for j in range(i, len(order)):
+            if bound(j, acc) <= found.threshold(float("-inf")) + 1e-9:
+                break
+
+            p = order[j]
+            if not feasible(p) or cost + p.cost > buget:
+                continue
+
+            need[p.position] -= 1
+            team_count[p.team] += 1
+            position_team_count[(p.position, p.team)] += 1
+            if p.position == "GKP":
+                gkp_teams[p.team] += 1
+            elif p.position == "DEF":
+                def_teams[p.team] += 1
+
+            picked.append(p)
+            branch(j + 1, picked, cost + p.cost, xp + p.xP, acc + reduced(p))
+            picked.pop()
+
+            need[p.position] += 1
+            team_count[p.team] -= 1
+            position_team_count[(p.position, p.team)] -= 1
+            if p.position == "GKP":
+                gkp_teams[p.team] -= 1
+            elif p.position == "DEF":
+                def_teams[p.team] -= 1
+
+    branch(
+        0,
+        [],
+        functions.lineup_cost(fixed),
+        sum(p.xP for p in fixed),
+        sum(reduced(p) for p in fixed)
+        + lam * buget
+        + sum(mu.values()) * team_limit
+        + sum(nu.values()),
+    )
+
+    print(f"Root bound (dual):       {best_dual:.1f}")
+    print(f"Nodes visited:           {nodes}")
+    best = found.lineups()
+    if best:
+        print(f"Proven optimum:          {functions.lineup_xp(best[0])}")
+
+    return best
+
+
+class _Candidates:
+
+    # The transfer pool grouped by position and sorted by cost, xP breaking
+    # ties, so every affordable replacement is a prefix of its bucket.
+
+    def __init__(self, pool: T.Iterable[structures.Player]):
+        self.players = {
+            pos: sorted(
+                (p for p in pool if p.position == pos),
+                key=lambda p: (p.cost, -p.xP),
+            )
+            for pos in gather.positions()
+        }
+        self.costs = {
+            pos: [p.cost for p in players] for pos, players in self.players.items()
+        }
+
+    def affordable(
+        self,
+        position: str,
+        limit: float,
+    ) -> T.List[structures.Player]:
+        stop = bisect.bisect_right(self.costs[position], limit)
+        return self.players[position][:stop]
+
+    def refund(
+        self,
+        squad: T.Sequence[structures.Player],
+        n: int,
+    ) -> int:
+        # The most money n further transfers out of squad could free up.
+        if n <= 0:
+            return 0
+        return sum(
+            sorted(
+                (
+                    max(0, p.cost - self.costs[p.position][0])
+                    for p in squad
+                    if self.costs[p.position]
+                ),
+                reverse=True,
+            )[:n]
+        )
 
 
 class Transfer:
@@ -246,76 +1305,199 @@ class Transfer:
         functions.tprint(old, new)
         print("-" * 100)
 
+    @staticmethod
+    def _better(
+        current: T.List[structures.Player],
+        best: T.List[structures.Player],
+        tc: structures.TransferConstraints,
+    ) -> bool:
+        return (
+            functions.lineup_xp(current) > functions.lineup_xp(best)
+            and functions.lineup_cost(current) <= tc.buget
+            and constraints.team_constraint(current, n=3)
+            and constraints.gkp_def_not_same_team(current)
+            and constraints.unique(current)
+            and Transfer.valid_add(current, tc.add)
+            and Transfer.valid_remove(current, tc.remove)
+        )
+
+    @staticmethod
+    def _moves(
+        current: T.List[structures.Player],
+        index: _Candidates,
+        tc: structures.TransferConstraints,
+        done_transfers: int,
+        start: int,
+    ) -> T.Iterator[T.Tuple[int, structures.Player]]:
+
+        # Only incoming players that fit the bank plus the most the remaining
+        # transfers could free up are produced, so the last transfer of a
+        # branch never exceeds the budget.
+        names = set(p.name for p in current)
+        bank = tc.buget - functions.lineup_cost(current)
+        remaining = tc.max_transfers - done_transfers - 1
+
+        for idx in range(start, len(current)):
+            out = current[idx]
+            limit = bank + out.cost + index.refund(current[idx + 1 :], remaining)
+            for transfer_in in index.affordable(out.position, limit):
+                if transfer_in.name not in names:
+                    yield idx, transfer_in
+
     @staticmethod
     def _transfer(
         current: T.List[structures.Player],
         best: T.List[structures.Player],
         original: T.List[structures.Player],
-        pool: T.List[structures.Player],
+        index: _Candidates,
         tc: structures.TransferConstraints,
         done_transfers: int,
+        start: int = 0,
+        seen: T.Optional[T.Set[T.FrozenSet[str]]] = None,
+        moves: T.Optional[T.Iterable[T.Tuple[int, structures.Player]]] = None,
     ) -> T.List[structures.Player]:
 
-        if done_transfers == tc.max_transfers:
-            if (
-                functions.lineup_xp(current) > functions.lineup_xp(best)
-                and functions.lineup_cost(current) <= tc.buget
-                and constraints.team_constraint(current, n=3)
-                and constraints.gkp_def_not_same_team(current)
-                and constraints.unique(current)
-                and Transfer.valid_add(current, tc.add)
-                and Transfer.valid_remove(current, tc.remove)
-            ):
-                return current
-            raise exceptions.InvalidLineup
+        # Transfers are enumerated as unordered sets of (slot, incoming
+        # player) pairs: slots only ever increase along a branch, so every
+        # slot is used at most once and no set is reached in two orders.
+        # Swapping two incoming players between slots of the same position
+        # still gives the same squad, so partial squads are memoized.
 
         if done_transfers > tc.max_transfers:
             raise exceptions.InvalidLineup
 
-        if done_transfers == 0:
-            _pool = tqdm(pool)
-        else:
-            _pool = pool
+        if done_transfers == tc.max_transfers:
+            return best
 
-        for transfer_in in _pool:
-            for idx, _ in enumerate(best):
+        if seen is None:
+            seen = set()
 
-                out = current[idx]
+        if moves is None:
+            moves = Transfer._moves(current, index, tc, done_transfers, start)
+            if done_transfers == 0:
+                moves = tqdm(list(moves))
 
-                if transfer_in.name == out.name or transfer_in.position != out.position:
-                    continue
+        names = set(p.name for p in current)
 
-                tmp = current.copy()
-                tmp[idx] = transfer_in
+        for idx, transfer_in in moves:
 
-                try:
-                    best = Transfer._transfer(
-                        current=tmp,
-                        best=best,
-                        pool=pool,
-                        original=original,
-                        tc=tc,
-                        done_transfers=done_transfers + 1,
-                    )
-                except exceptions.InvalidLineup:
-                    continue
+            out = current[idx]
+            tmp = current.copy()
+            tmp[idx] = transfer_in
 
+            if Transfer._better(tmp, best, tc):
+                best = tmp
                 if settings.Global.verbose:
                     Transfer._tprint(original, best)
 
+            if done_transfers + 1 == tc.max_transfers:
+                assert functions.lineup_cost(tmp) <= tc.buget
+                continue
+
+            key = frozenset(names - {out.name} | {transfer_in.name})
+            if key in seen:
+                continue
+            seen.add(key)
+
+            best = Transfer._transfer(
+                current=tmp,
+                best=best,
+                original=original,
+                index=index,
+                tc=tc,
+                done_transfers=done_transfers + 1,
+                start=idx + 1,
+                seen=seen,
+            )
+
+        return best
+
+    _state: T.Dict[str, T.Any] = {}
+
+    @staticmethod
+    def _init(
+        old: T.List[structures.Player],
+        index: _Candidates,
+        tc: structures.TransferConstraints,
+    ) -> None:
+        Transfer._state.update(old=old, index=index, tc=tc)
+
+    @staticmethod
+    def _first(
+        move: T.Tuple[int, structures.Player],
+    ) -> T.Optional[T.List[structures.Player]]:
+
+        # One first-level transfer followed by the remaining depths. Returns
+        # the local best, None if nothing beats the old squad.
+        old: T.List[structures.Player] = Transfer._state["old"]
+        best = Transfer._transfer(
+            current=old,
+            best=old,
+            original=old,
+            index=Transfer._state["index"],
+            tc=Transfer._state["tc"],
+            done_transfers=0,
+            moves=(move,),
+        )
+        return None if best is old else best
+
+    @staticmethod
+    def _parallel(
+        old: T.List[structures.Player],
+        index: _Candidates,
+        tc: structures.TransferConstraints,
+        workers: int,
+    ) -> T.List[structures.Player]:
+
+        moves = list(Transfer._moves(old, index, tc, 0, 0))
+
+        print(f"Workers:                 {workers}")
+
+        best = old.copy()
+        with concurrent.futures.ProcessPoolExecutor(
+            workers,
+            initializer=Transfer._init,
+            initargs=(old, index, tc),
+        ) as executor:
+            # Results arrive in the serial order of first transfers and are
+            # reduced with the same strict check as the serial search.
+            for local in tqdm(
+                executor.map(
+                    Transfer._first,
+                    moves,
+                    chunksize=max(1, len(moves) // (workers * 8)),
+                ),
+                total=len(moves),
+            ):
+                if local is not None and Transfer._better(local, best, tc):
+                    best = local
+                    if settings.Global.verbose:
+                        Transfer._tprint(old, best)
         return best
 
+    @staticmethod
+    def candidates(
+        pool: T.Iterable[structures.Player],
+        ignore: T.Tuple[str, ...] = tuple(),
+    ) -> _Candidates:
+        # The index solve searches, build it once to share it between the
+        # squads of many solves over the same pool.
+        return _Candidates([p for p in pool if p.name not in ignore])
+
     @staticmethod
     def solve(
         old: T.List[structures.Player],
         pool: T.List[structures.Player],
         tc: structures.TransferConstraints,
+        workers: int = 1,
+        index: T.Optional[_Candidates] = None,
     ) -> T.List[structures.Player]:
 
-        pool = list(set(pool) - set(old))
-        pool = sorted(pool, key=lambda p: p.xP, reverse=False)
+        # A given index must come from candidates(pool, tc.ignore). It may
+        # hold players of old: bringing one back in only rebuilds a squad
+        # fewer transfers reach, which never counts as better.
+        pool = [p for p in set(pool) - set(old) if p.name not in tc.ignore]
         old = sorted(old, key=lambda p: p.xP, reverse=False)
-        pool = [p for p in pool if p.name not in tc.ignore]
 
         for p in tc.add:
             if not any(l.name == p for l in pool):
@@ -325,20 +1507,239 @@ class Transfer:
             if not any(l.name == p for l in old):
                 print(f"Player '{p}' not in current lineup.")
 
+        # Serial unless more workers are asked for, a process pool costs more
+        # to start than most searches take.
+        if index is None:
+            index = Transfer.candidates(pool)
+
         try:
-            best = Transfer._transfer(
-                current=old,
-                best=old.copy(),
-                original=old.copy(),
-                pool=pool,
-                tc=tc,
-                done_transfers=0,
-            )
+            if workers > 1 and tc.max_transfers > 0:
+                best = Transfer._parallel(old, index, tc, workers)
+            else:
+                best = Transfer._transfer(
+                    current=old,
+                    best=old.copy(),
+                    original=old.copy(),
+                    index=index,
+                    tc=tc,
+                    done_transfers=0,
+                )
         finally:
             Transfer._tprinted.clear()
         return best
 
 
+class Planner:
+
+    # Beam search over (gameweek, squad, banked free transfers) for a rolling
+    # horizon with per-gameweek xP. A state is pruned when even its
+    # optimistic bound, holding the squad and upgrading the weakest slots to
+    # the best player of their position every week, cannot reach the value
+    # of another state that simply holds its squad from here on. Only the
+    # best few incoming players per slot are tried and only pc.width states
+    # are kept per gameweek, so this is a heuristic, not an exact search.
+
+    @staticmethod
+    def xi(
+        squad: T.Sequence[structures.Player],
+        xp: T.Sequence[float],
+    ) -> float:
+        # Best starting XI under constraints.valid_formation: the best GKP,
+        # three DEF and one FWD are forced, the rest is the best of the field.
+        by_position: T.Dict[str, T.List[float]] = {
+            pos: sorted(
+                (x for p, x in zip(squad, xp) if p.position == pos), reverse=True
+            )
+            for pos in gather.positions()
+        }
+        forced = (
+            by_position["GKP"][:1] + by_position["DEF"][:3] + by_position["FWD"][:1]
+        )
+        rest = sorted(
+            by_position["DEF"][3:] + by_position["MID"] + by_position["FWD"][1:],
+            reverse=True,
+        )
+        return sum(forced) + sum(rest[: 11 - len(forced)])
+
+    @staticmethod
+    def _valid(
+        squad: T.Sequence[structures.Player],
+        pc: structures.PlanConstraints,
+    ) -> bool:
+        return (
+            functions.lineup_cost(squad) <= pc.buget
+            and constraints.team_constraint(squad, n=3)
+            and constraints.gkp_def_not_same_team(squad)
+            and constraints.unique(squad)
+        )
+
+    @staticmethod
+    def solve(
+        old: T.List[structures.Player],
+        pool: T.List[structures.Player],
+        xp: T.Mapping[str, T.Sequence[float]],
+        pc: structures.PlanConstraints,
+    ) -> T.List[structures.GameweekPlan]:
+
+        def week(p: structures.Player, w: int) -> float:
+            values = xp.get(p.name, ())
+            return values[w] if w < len(values) else 0.0
+
+        def horizon(p: structures.Player, w: int) -> float:
+            return sum(week(p, i) for i in range(w, pc.horizon))
+
+        def hold(squad: T.Sequence[structures.Player], w: int) -> float:
+            return sum(
+                Planner.xi(squad, [week(p, i) for p in squad])
+                for i in range(w, pc.horizon)
+            )
+
+        best_in_position = [
+            {
+                pos: max((week(p, i) for p in pool if p.position == pos), default=0.0)
+                for pos in gather.positions()
+            }
+            for i in range(pc.horizon)
+        ]
+
+        def bound(squad: T.Sequence[structures.Player], w: int) -> float:
+            # Slots keep their position, so a squad with t changed slots can
+            # at most gain the t largest per-slot headrooms over its XI.
+            total = 0.0
+            for i in range(w, pc.horizon):
+                headroom = sorted(
+                    (
+                        max(0.0, best_in_position[i][p.position] - week(p, i))
+                        for p in squad
+                    ),
+                    reverse=True,
+                )
+                total += Planner.xi(squad, [week(p, i) for p in squad]) + sum(
+                    headroom[: pc.max_transfers * (i - w + 1)]
+                )
+            return total
+
+        current = set(old)
+        pool = [p for p in pool if p not in current]
+
+        State = T.Tuple[
+            T.Tuple[structures.Player, ...],
+            int,
+            float,
+            T.Tuple[structures.GameweekPlan, ...],
+        ]
+        states: T.List[State] = [(tuple(old), pc.free_transfers, 0.0, ())]
+
+        for w in tqdm(range(pc.horizon)):
+
+            ranked = {
+                pos: sorted(
+                    (p for p in pool if p.position == pos),
+                    key=lambda p: horizon(p, w),
+                    reverse=True,
+                )
+                for pos in gather.positions()
+            }
+
+            successors: T.Dict[T.Tuple[T.FrozenSet[str], int], State] = {}
+
+            for squad, bank, value, path in states:
+
+                names = set(p.name for p in squad)
+
+                # The best few incoming players per slot that make a valid
+                # single transfer; combinations are re-validated below.
+                singles = []
+                for idx, out in enumerate(squad):
+                    incoming = itertools.islice(
+                        (
+                            p
+                            for p in ranked[out.position]
+                            if p.name not in names
+                            and Planner._valid(
+                                squad[:idx] + (p,) + squad[idx + 1 :], pc
+                            )
+                        ),
+                        pc.candidates,
+                    )
+                    for transfer_in in incoming:
+                        gain = horizon(transfer_in, w) - horizon(out, w)
+                        if gain <= 0:
+                            break
+                        singles.append((gain, idx, transfer_in))
+
+                singles.sort(key=lambda s: s[0], reverse=True)
+                singles = singles[: pc.candidates * 3]
+
+                moves: T.List[T.Tuple[T.Tuple[int, structures.Player], ...]] = [()]
+                for k in range(1, pc.max_transfers + 1):
+                    for combination in itertools.combinations(singles, k):
+                        slots = set(idx for _, idx, _ in combination)
+                        names_in = set(p.name for *_, p in combination)
+                        if len(slots) == k and len(names_in) == k:
+                            moves.append(tuple((idx, p) for _, idx, p in combination))
+
+                for move in moves:
+                    new = list(squad)
+                    for idx, transfer_in in move:
+                        new[idx] = transfer_in
+
+                    if move and not Planner._valid(new, pc):
+                        continue
+
+                    hits = max(0, len(move) - bank)
+                    banked = min(pc.max_banked, max(0, bank - len(move)) + 1)
+                    gained = Planner.xi(new, [week(p, w) for p in new]) - hits * pc.hit
+
+                    step = structures.GameweekPlan(
+                        gameweek=w,
+                        transfers=tuple((squad[idx], p) for idx, p in move),
+                        free_transfers=bank,
+                        hits=hits,
+                        xP=round(gained, 1),
+                    )
+                    key = (frozenset(p.name for p in new), banked)
+                    if key not in successors or successors[key][2] < value + gained:
+                        successors[key] = (
+                            tuple(new),
+                            banked,
+                            value + gained,
+                            path + (step,),
+                        )
+
+            # A state is dominated by the same squad with at least as many
+            # banked transfers and at least the same value.
+            best_by_squad: T.Dict[T.FrozenSet[str], T.List[State]] = C.defaultdict(list)
+            for (squad_key, _), state in successors.items():
+                best_by_squad[squad_key].append(state)
+
+            candidates = [
+                state
+                for group in best_by_squad.values()
+                for state in group
+                if not any(
+                    other is not state and other[1] >= state[1] and other[2] >= state[2]
+                    for other in group
+                )
+            ]
+
+            lower = max(value + hold(squad, w + 1) for squad, _, value, _ in candidates)
+            candidates = [
+                state
+                for state in candidates
+                if state[2] + bound(state[0], w + 1) >= lower
+            ]
+
+            candidates.sort(key=lambda s: s[2] + hold(s[0], w + 1), reverse=True)
+            states = candidates[: pc.width]
+
+            if settings.Global.verbose:
+                print(f"gameweek={w}, states={len(successors)}, kept={len(states)}")
+
+        *_, path = max(states, key=lambda s: s[2])
+        return list(path)
+
+
 def gmw_lineup(
     current: T.List[structures.Player],
     gmw: T.Optional[int] = None,
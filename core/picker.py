@@ -5,10 +5,13 @@ from plotille import (
 )
 
 from core import (
+    backtest,
     functions,
     gather,
+    league,
     optimizers,
     settings,
+    simulator,
     structures,
 )
 
@@ -25,7 +28,12 @@ def argument_parser():
         "-r",
         "--refresh",
         action="store_true",
-        help="Refreshes locally cached FPL APIs.",
+        help="Refreshes locally cached FPL APIs, only refetching what changed.",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="Drops all locally cached FPL APIs and fetches everything again.",
     )
 
     sub_parsers = parser.add_subparsers(dest="mode", required=True)
@@ -71,6 +79,128 @@ def argument_parser():
         default=None,
         help="The players whos expected points are below this value will not be part of the player pool.",
     )
+    transfer_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, more than 1 searches on a process pool, default is: 1.",
+    )
+    transfer_parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Also print the simulated points distribution of the old and new squad.",
+    )
+
+    backtest_parser = sub_parsers.add_parser(
+        "backtest",
+    )
+    backtest_parser.add_argument(
+        "season",
+        type=str,
+        help="Season folder in data/ to replay, e.g. 2021_2022.",
+    )
+    backtest_parser.add_argument(
+        "-t",
+        "--transfers",
+        type=int,
+        default=1,
+        help="Number of allowed transfers per gameweek, default is: 1.",
+    )
+    backtest_parser.add_argument(
+        "-s",
+        "--solver",
+        choices=("nested", "mitm", "bnb", "parallel"),
+        default="bnb",
+        help="Search strategy for the initial squad, default is: bnb.",
+    )
+    backtest_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes, default is: number of cores.",
+    )
+    backtest_parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore any checkpoint and replay the season from the start.",
+    )
+
+    league_parser = sub_parsers.add_parser(
+        "league",
+    )
+    league_parser.add_argument(
+        "teams",
+        type=int,
+        nargs="+",
+        help="FPL team id(s) to suggest transfers for.",
+    )
+    league_parser.add_argument(
+        "-t",
+        "--transfers",
+        type=int,
+        default=1,
+        help="Number of allowed transfers per team, default is: 1.",
+    )
+    league_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes, default is: number of cores.",
+    )
+    league_parser.add_argument(
+        "-xp",
+        "--expected-points",
+        type=float,
+        default=None,
+        help="The players whos expected points are below this value will not be part of the player pool.",
+    )
+
+    plan_parser = sub_parsers.add_parser(
+        "plan",
+        description=(
+            "Plans transfers over the next gameweeks with a beam search. It is "
+            "a heuristic: only the best --width squads are kept per gameweek, "
+            "so the best plan is not guaranteed."
+        ),
+    )
+    plan_parser.add_argument(
+        "horizon",
+        type=int,
+        nargs="?",
+        default=5,
+        help="Number of gameweeks to plan ahead, default is: 5.",
+    )
+    plan_parser.add_argument(
+        "-t",
+        "--transfers",
+        type=int,
+        default=2,
+        help="Max number of transfers per gameweek, default is: 2.",
+    )
+    plan_parser.add_argument(
+        "-f",
+        "--free-transfers",
+        type=int,
+        default=1,
+        help="Free transfers available this gameweek, default is: 1.",
+    )
+    plan_parser.add_argument(
+        "-w",
+        "--width",
+        type=int,
+        default=100,
+        help="Number of squads kept per gameweek by the beam search, a larger width finds better plans but is slower, default is: 100.",
+    )
+    plan_parser.add_argument(
+        "-xp",
+        "--expected-points",
+        type=float,
+        default=None,
+        help="The players whos expected points are below this value will not be part of the player pool.",
+    )
 
     lineup_parser = sub_parsers.add_parser(
         "lineup",
@@ -125,6 +255,32 @@ def argument_parser():
         default=None,
         help="The players whos expected points are below this value will not be part of the player pool.",
     )
+    lineup_parser.add_argument(
+        "-s",
+        "--solver",
+        choices=("nested", "mitm", "bnb", "parallel"),
+        default="nested",
+        help="Search strategy, 'mitm' pairs GKP+DEF against MID+FWD, 'bnb' is an exact branch-and-bound over the full pool, 'parallel' shards the nested search over a process pool, default is: nested.",
+    )
+    lineup_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for the parallel solver, default is: number of cores.",
+    )
+    lineup_parser.add_argument(
+        "-k",
+        "--top",
+        type=int,
+        default=1,
+        help="Number of best lineups to return from the search, default is: 1.",
+    )
+    lineup_parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Also print the simulated points distribution of the lineup(s).",
+    )
 
     print_parser = sub_parsers.add_parser(
         "print",
@@ -154,8 +310,8 @@ def main():
 
     settings.Global.verbose = parsed.verbose
 
-    if parsed.refresh:
-        gather.refresh()
+    if parsed.refresh or parsed.full_refresh:
+        gather.refresh(full=parsed.full_refresh)
 
     if parsed.mode == "transfer":
         old = gather.team()
@@ -174,33 +330,113 @@ def main():
                 ignore=parsed.ignore,
                 buget=functions.lineup_cost(old),
             ),
+            workers=parsed.workers,
         )
         functions.tprint(old, new)
+        if parsed.simulate:
+            _, (before, after) = simulator.simulate(
+                sorted(set(p.name for p in old + new)),
+                [[p.name for p in old], [p.name for p in new]],
+            )
+            functions.dprint(before, prefix="old: ")
+            functions.dprint(after, prefix="new: ")
 
-    elif parsed.mode == "lineup":
+    elif parsed.mode == "backtest":
+        backtest.report(
+            backtest.run(
+                season=parsed.season,
+                max_transfers=parsed.transfers,
+                solver=parsed.solver,
+                workers=parsed.workers,
+                resume=not parsed.restart,
+            )
+        )
+
+    elif parsed.mode == "league":
+        print(
+            league.solve(
+                team_ids=parsed.teams,
+                max_transfers=parsed.transfers,
+                min_xp=parsed.expected_points,
+                workers=parsed.workers,
+            ).to_string(index=False)
+        )
+
+    elif parsed.mode == "plan":
+        old = gather.team()
         pool = functions.remove_bad(
             gather.player_pool(),
             parsed.expected_points,
-            must=set(
-                parsed.goalkeepers
-                + parsed.defenders
-                + parsed.midfielders
-                + parsed.forwards
+            must=set(),
+        )
+        names = sorted(set(p.name for p in old + pool))
+        plan = optimizers.Planner.solve(
+            old=old,
+            pool=pool,
+            xp=dict(zip(names, simulator.gameweeks(names, parsed.horizon).tolist())),
+            pc=structures.PlanConstraints(
+                horizon=parsed.horizon,
+                buget=functions.lineup_cost(old),
+                free_transfers=parsed.free_transfers,
+                max_transfers=parsed.transfers,
+                width=parsed.width,
             ),
         )
-        functions.sprint(
-            optimizers.lineup(
-                pool=pool,
-                buget=int(parsed.buget * 10),
-                ignore=parsed.ignore,
-                base=(
-                    tuple(parsed.goalkeepers),
-                    tuple(parsed.defenders),
-                    tuple(parsed.midfielders),
-                    tuple(parsed.forwards),
+        gameweek = gather.current_gameweek()
+        for step in plan:
+            print(
+                f"Gameweek: {gameweek + step.gameweek}, "
+                f"free transfers: {step.free_transfers}, "
+                f"hits: {step.hits}, xP: {step.xP}"
+            )
+            for out, transfer_in in step.transfers:
+                print(
+                    f"    {out.name} ({out.team}) => "
+                    f"{transfer_in.name} ({transfer_in.team})"
+                )
+
+    elif parsed.mode == "lineup":
+        table = gather.player_table()
+        # The exact solver does not need the xP cutoff to keep the search small.
+        if parsed.solver != "bnb" or parsed.expected_points is not None:
+            table = functions.remove_bad(
+                table,
+                parsed.expected_points,
+                must=set(
+                    parsed.goalkeepers
+                    + parsed.defenders
+                    + parsed.midfielders
+                    + parsed.forwards
                 ),
             )
+        lineups = optimizers.lineups(
+            pool=table,
+            buget=int(parsed.buget * 10),
+            ignore=parsed.ignore,
+            base=(
+                tuple(parsed.goalkeepers),
+                tuple(parsed.defenders),
+                tuple(parsed.midfielders),
+                tuple(parsed.forwards),
+            ),
+            solver=parsed.solver,
+            workers=parsed.workers,
+            top=parsed.top,
+        )
+        _, simulated = (
+            simulator.simulate(
+                sorted(set(p.name for best in lineups for p in best)),
+                [[p.name for p in best] for best in lineups],
+            )
+            if parsed.simulate and lineups
+            else ({}, [])
         )
+        for idx, best in enumerate(lineups):
+            if idx:
+                print("-" * 100)
+            functions.sprint(best)
+            if simulated:
+                functions.dprint(simulated[idx], prefix="simulated: ")
 
     elif parsed.mode == "print":
         if parsed.show == "team":
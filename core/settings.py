@@ -1,2 +1,47 @@
 class Global:
     verbose = False
+
+
+class Fetch:
+    # Shared by every request to the FPL API and the historical data.
+    concurrency = 16
+    rate = 10.0  # requests per second
+    retries = 5
+    backoff = 0.5  # seconds, doubled per attempt and jittered
+    timeout = 30.0
+
+
+class Cache:
+    # Results kept in memory per cached function, least recently used first
+    # out.
+    memory = 1_024
+    # Seconds a cached API response stays valid per namespace. Namespaces not
+    # listed never expire, e.g. entry_picks of finished gameweeks.
+    ttl = {
+        "bootstrap_static": 15 * 60,
+        "fixtures": 60 * 60,
+        "gameweek": 60 * 60,
+        "my_team": 15 * 60,
+    }
+    # gzip the files on disk.
+    compress = False
+
+
+class Team:
+    # Seconds a resolved squad is reused for the same team and gameweek.
+    ttl = 300.0
+    # Resolved squads kept in memory, least recently used first out.
+    memory = 1_024
+
+
+class Seasons:
+    # Finished seasons from github.com/vaastav/Fantasy-Premier-League, as
+    # named there. They never change, so complete ones are not fetched again.
+    past = ("2020-21", "2021-22", "2022-23", "2023-24", "2024-25")
+    url = "https://raw.githubusercontent.com/vaastav/Fantasy-Premier-League/master/data/{season}/{file}"
+    # Local file name -> path within the season.
+    files = {
+        "merged_gw.csv": "gws/merged_gw.csv",
+        "teams.csv": "teams.csv",
+    }
+    workers = 4
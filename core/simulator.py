@@ -1,39 +1,46 @@
+import hashlib
+import io
+import json
+import pathlib
 import typing as T
+import zipfile
 
 import numpy as np
 
 from core import (
+    cache,
     gather,
     structures,
 )
 
 
-def performed(
-    player: str,
+def strength(row: T.Any) -> structures.Strength:
+    # Opponent strength of a merged history row.
+    if row.was_home:
+        return structures.Strength(
+            attack=int(row.strength_defence_home),
+            defence=int(row.strength_defence_home),
+            overall=int(row.strength_overall_home),
+            home=bool(row.was_home),
+        )
+    return structures.Strength(
+        attack=int(row.strength_defence_away),
+        defence=int(row.strength_defence_away),
+        overall=int(row.strength_overall_away),
+        home=bool(row.was_home),
+    )
+
+
+def performances(
+    rows: T.Iterable[T.Any],
     window: int = 3,
 ) -> T.Generator[T.Tuple[float, float, T.Tuple[float, ...]], None, None]:
 
     assert window > 0
 
-    historical: T.List[T.Tuple[int, structures.Strength]] = []
-
-    for row in gather.history(player):
-        if row.was_home:
-            s = structures.Strength(
-                attack=int(row.strength_defence_home),
-                defence=int(row.strength_defence_home),
-                overall=int(row.strength_overall_home),
-                home=bool(row.was_home),
-            )
-        else:
-            s = structures.Strength(
-                attack=int(row.strength_defence_away),
-                defence=int(row.strength_defence_away),
-                overall=int(row.strength_overall_away),
-                home=bool(row.was_home),
-            )
-
-        historical.append((int(row.total_points), s))
+    historical: T.List[T.Tuple[int, structures.Strength]] = [
+        (int(row.total_points), strength(row)) for row in rows
+    ]
 
     historical.reverse()
     historical = historical[-window * window :]
@@ -47,6 +54,214 @@ def performed(
         )
 
 
+def performed(
+    player: str,
+    window: int = 3,
+) -> T.Generator[T.Tuple[float, float, T.Tuple[float, ...]], None, None]:
+    yield from performances(gather.history(player), window)
+
+
+# Layout of the stored models, part of the fingerprint so stores written
+# before a layout change are retrained instead of misread.
+STORE_VERSION = 2
+
+# Shared per-player table of (coefficients, last window features, residual
+# standard deviation), the features are None for players without any
+# history. Filled by train.
+_trained: T.Dict[
+    str, T.Tuple[np.ndarray, T.Optional[T.Tuple[float, ...]], float]
+] = {}
+
+
+def _fingerprint(
+    players: T.Sequence[str],
+    window: int,
+    folder: pathlib.Path = pathlib.Path("data"),
+) -> str:
+
+    # Everything training depends on: the store layout, the historical CSVs,
+    # the window, the players and the element names used to resolve history
+    # rows.
+    digest = hashlib.sha256()
+    digest.update(f"{STORE_VERSION},{window}".encode())
+    for file in sorted(folder.glob("*_*/*.csv")):
+        digest.update(str(file).encode())
+        with file.open("rb") as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b""):
+                digest.update(chunk)
+    digest.update(
+        json.dumps(
+            [players, [e["web_name"] for e in gather.bootstrap_static()["elements"]]]
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def fit(
+    performances: T.Sequence[
+        T.Sequence[T.Tuple[float, float, T.Tuple[float, ...]]]
+    ],
+    window: int = 3,
+) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+    # All players are solved as one stack of least squares problems. Short
+    # histories are padded with zero rows, which leaves their solution as is.
+    # Returns coefficients, last window features, residual spread and
+    # whether the player had any performances at all.
+    coefficients = np.zeros((len(performances), window))
+    features = np.zeros((len(performances), window))
+    sigma = np.zeros(len(performances))
+    known = np.array([bool(rows) for rows in performances], dtype=bool)
+    trained = [rows for rows in performances if rows]
+
+    if not trained:
+        return coefficients, features, sigma, known
+
+    longest = max(len(rows) for rows in trained)
+    design = np.zeros((len(trained), longest, window))
+    target = np.zeros((len(trained), longest, 1))
+
+    for idx, rows in enumerate(trained):
+        for row, (tp, s, v) in enumerate(rows):
+            design[idx, row] = v
+            target[idx, row] = s * tp
+
+    # pinv gives the same minimum norm solution as lstsq, also when a
+    # player has fewer performances than coefficients.
+    solved = np.linalg.pinv(design) @ target
+    coefficients[known] = solved[..., 0]
+    features[known] = [rows[0][-1] for rows in trained]
+
+    # Residual spread per player, players with too few performances to
+    # estimate their own fall back to the pooled estimate.
+    rss = ((target - design @ solved) ** 2).sum(axis=(1, 2))
+    dof = np.array([len(rows) for rows in trained]) - window
+    pooled = np.sqrt(rss[dof > 0].sum() / dof[dof > 0].sum()) if any(dof > 0) else 0
+    sigma[known] = np.where(dof > 0, np.sqrt(rss / np.maximum(dof, 1)), pooled)
+
+    return coefficients, features, sigma, known
+
+
+def train(
+    players: T.Iterable[str],
+    window: int = 3,
+    prune: bool = False,
+) -> None:
+
+    # Fits the players, or loads them from the store of their fingerprint.
+    # Only the pool-wide call prunes, the stores of other fingerprints are
+    # stale then, while a subset trained on the side must not evict the
+    # pool's store.
+    players = list(players)
+    store = cache.CACHE_FOLDER / "models" / f"{_fingerprint(players, window)}.npz"
+
+    try:
+        with np.load(store) as npz:
+            loaded = {
+                str(player): (
+                    coefficient,
+                    tuple(features.tolist()) if known else None,
+                    float(sigma),
+                )
+                for player, coefficient, features, known, sigma in zip(
+                    npz["players"],
+                    npz["coefficients"],
+                    npz["features"],
+                    npz["known"],
+                    npz["sigma"],
+                )
+            }
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # Missing, or unreadable e.g. cut short by a crash, retrain below.
+        pass
+    else:
+        _trained.update(loaded)
+        return
+
+    coefficients, features, sigma, known = fit(
+        [tuple(performed(player, window)) for player in players], window
+    )
+
+    for idx, player in enumerate(players):
+        _trained[player] = (
+            coefficients[idx],
+            tuple(features[idx].tolist()) if known[idx] else None,
+            float(sigma[idx]),
+        )
+
+    # Written atomically, a crash never leaves a partial store behind.
+    body = io.BytesIO()
+    np.savez(
+        body,
+        players=np.array(players, dtype=str),
+        coefficients=coefficients,
+        features=features,
+        known=known,
+        sigma=sigma,
+    )
+    cache.write(store, body.getvalue())
+
+    if not prune:
+        return
+
+    for stale in store.parent.glob("*.npz"):
+        if stale != store:
+            stale.unlink(missing_ok=True)
+
+
+def expected(players: T.Sequence[str]) -> np.ndarray:
+
+    # Model(player).xP() of many trained players at once. Players without an
+    # upcoming fixture get 0.
+    row, opponents, _, strength, _ = gather.fixture_table()
+    if not players or not opponents.shape[1]:
+        return np.zeros(len(players))
+
+    rows = np.array([row[gather.player_team(player)] for player in players])
+    coefficients = np.array([_trained[player][0] for player in players])
+    features = np.array(
+        [_trained[player][1] or (0.0,) * coefficients.shape[1] for player in players]
+    )
+    scheduled = opponents[rows, 0] != 0
+    strengths = np.where(scheduled, strength[rows, 0].mean(axis=1), 1.0)
+
+    xp = (coefficients * features).sum(axis=1) / strengths
+    return np.array(
+        [round(v, 1) if s else 0.0 for v, s in zip(xp.tolist(), scheduled.tolist())]
+    )
+
+
+def gameweeks(players: T.Sequence[str], n: int) -> np.ndarray:
+
+    # xP of many trained players in each of the next n gameweeks, as a
+    # (player, gameweek) array. A double gameweek sums its fixtures and a
+    # blank gameweek is 0.
+    row, opponents, _, strength, event = gather.fixture_table()
+    xp = np.zeros((len(players), n))
+    if not players or not opponents.shape[1]:
+        return xp
+
+    missing = [p for p in players if p not in _trained]
+    if missing:
+        train(missing)
+
+    rows = np.array([row[gather.player_team(player)] for player in players])
+    coefficients = np.array([_trained[player][0] for player in players])
+    features = np.array(
+        [_trained[player][1] or (0.0,) * coefficients.shape[1] for player in players]
+    )
+    scheduled = opponents[rows] != 0
+    strengths = np.where(scheduled, strength[rows].mean(axis=2), 1.0)
+    fixtures = np.round(
+        (coefficients * features).sum(axis=1)[:, None] / strengths, 1
+    )
+
+    first = gather.current_gameweek()
+    for w in range(n):
+        xp[:, w] = np.where(event[rows] == first + w, fixtures, 0.0).sum(axis=1)
+    return xp
+
+
 class Model:
     def __init__(self, player: str):
         self.player = player
@@ -61,8 +276,19 @@ class Model:
             self._performed = tuple(performed(self.player))
         return self._performed
 
+    @property
+    def features(self) -> T.Optional[T.Tuple[float, ...]]:
+        if self.player in _trained:
+            _, features, _ = _trained[self.player]
+            return features
+        return self.performed[0][-1] if self.performed else None
+
     def train(self):
 
+        if self.player in _trained:
+            self._model, *_ = _trained[self.player]
+            return
+
         if not self.performed:
             return
 
@@ -79,9 +305,160 @@ class Model:
 
         next_team_stg = gather.strength_next_n(self.player, n=1)[0]
 
-        if not self.performed:
+        last3 = self.features
+        if last3 is None:
             return 0
 
-        last3 = self.performed[0][-1]
         assert self._model is not None
         return round(self._model.dot(last3) / next_team_stg.mean(), 1)
+
+    def xPs(self, n: int) -> T.Tuple[float, ...]:
+
+        if not self._model.all():
+            self.train()
+
+        last3 = self.features
+        if last3 is None:
+            return (0.0,) * n
+
+        # One value per upcoming fixture in kickoff order, not per gameweek:
+        # a double gameweek takes two values and a blank one none. Padded
+        # with zeros when fewer than n fixtures are scheduled.
+        xps = tuple(
+            round(self._model.dot(last3) / stg.mean(), 1)
+            for stg in gather.strength_next_n(self.player, n=n)
+        )
+        return xps + (0.0,) * (n - len(xps))
+
+
+class _Histogram:
+
+    # Streaming mean, variance and fixed-bin quantiles for a set of rows, so
+    # samples can be consumed block by block in bounded memory.
+
+    def __init__(
+        self,
+        center: np.ndarray,
+        scale: np.ndarray,
+        bins: int,
+        span: float = 6.0,
+    ):
+        self.center = center
+        self.scale = scale
+        self.lower = center - span * scale
+        self.width = np.maximum(2 * span * scale / bins, 1e-12)
+        self.bins = bins
+        self.counts = np.zeros((len(center), bins), dtype=np.int64)
+        self.n = 0
+        self.total = np.zeros(len(center))
+        self.squares = np.zeros(len(center))
+
+    def update(self, samples: np.ndarray) -> None:
+        # samples: (block, rows)
+        shifted = samples - self.center
+        self.n += len(samples)
+        self.total += shifted.sum(axis=0)
+        self.squares += (shifted**2).sum(axis=0)
+
+        idx = ((samples - self.lower) // self.width).astype(np.int64)
+        np.clip(idx, 0, self.bins - 1, out=idx)
+        idx += np.arange(len(self.center)) * self.bins
+        self.counts += np.bincount(idx.ravel(), minlength=self.counts.size).reshape(
+            self.counts.shape
+        )
+
+    def distributions(
+        self,
+        quantiles: T.Sequence[float],
+    ) -> T.List[structures.Distribution]:
+        mean = self.total / self.n
+        variance = self.squares / self.n - mean**2
+        cdf = np.cumsum(self.counts, axis=1) / self.n
+
+        values = []
+        for q in quantiles:
+            # Linear interpolation inside the first bin reaching q.
+            idx = np.argmax(cdf >= q, axis=1)
+            rows = np.arange(len(idx))
+            below = np.where(idx > 0, cdf[rows, np.maximum(idx - 1, 0)], 0.0)
+            inside = self.counts[rows, idx] / self.n
+            fraction = np.where(
+                inside > 0, (q - below) / np.maximum(inside, 1e-300), 0.5
+            )
+            values.append(
+                np.where(
+                    self.scale > 0,
+                    self.lower + (idx + fraction) * self.width,
+                    self.center,
+                )
+            )
+
+        return [
+            structures.Distribution(
+                mean=float(self.center[row] + mean[row]),
+                variance=float(max(variance[row], 0.0)),
+                quantiles=tuple(
+                    (float(q), float(v[row])) for q, v in zip(quantiles, values)
+                ),
+            )
+            for row in range(len(self.center))
+        ]
+
+
+def simulate(
+    players: T.Sequence[str],
+    lineups: T.Sequence[T.Sequence[str]] = (),
+    samples: int = 10_000,
+    seed: int = 0,
+    block: int = 4_096,
+    bins: int = 1_024,
+    quantiles: T.Sequence[float] = (0.05, 0.25, 0.5, 0.75, 0.95),
+) -> T.Tuple[T.Dict[str, structures.Distribution], T.List[structures.Distribution]]:
+
+    # Next gameweek points are drawn for all players at once: the model's
+    # prediction plus a normal residual with the player's own spread, both
+    # scaled by the strength of the next opponent like Model.xP. Lineups are
+    # scored as sums of the same draws, so shared players stay correlated.
+
+    players = list(players)
+    missing = [p for p in players if p not in _trained]
+    if missing:
+        train(missing)
+
+    center = np.zeros(len(players))
+    scale = np.zeros(len(players))
+    for idx, player in enumerate(players):
+        coefficients, features, sigma = _trained[player]
+        if features is None:
+            continue
+        strength = gather.strength_next_n(player, n=1)[0].mean()
+        center[idx] = coefficients.dot(features) / strength
+        scale[idx] = sigma / strength
+
+    column = {player: idx for idx, player in enumerate(players)}
+    incidence = np.zeros((len(players), len(lineups)))
+    for idx, lineup in enumerate(lineups):
+        for player in lineup:
+            incidence[column[player], idx] += 1
+
+    per_player = _Histogram(center, scale, bins)
+    per_lineup = _Histogram(
+        center @ incidence, np.sqrt((scale**2) @ incidence), bins
+    )
+
+    # Every block has its own child seed, so the result only depends on the
+    # seed and the block size, never on how the work is scheduled.
+    blocks = range(0, samples, block)
+    for start, child in zip(blocks, np.random.SeedSequence(seed).spawn(len(blocks))):
+        rng = np.random.default_rng(child)
+        draws = center + scale * rng.standard_normal(
+            (min(block, samples - start), len(players))
+        )
+        per_player.update(draws)
+        if lineups:
+            per_lineup.update(draws @ incidence)
+
+    return (
+        dict(zip(players, per_player.distributions(quantiles))),
+        per_lineup.distributions(quantiles) if lineups else [],
+    )
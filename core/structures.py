@@ -1,6 +1,8 @@
 import dataclasses
 import typing as T
 
+import numpy as np
+
 
 @dataclasses.dataclass(frozen=True, eq=True)
 class Strength:
@@ -38,6 +40,104 @@ class Player:
     xP: float
 
 
+@dataclasses.dataclass(frozen=True, eq=False)
+class PlayerTable:
+    # Column per Player field, row i is one player. Team and position are
+    # codes into teams and positions, id the FPL element ids when the table
+    # was built from the bootstrap. Indexing with an index array or mask
+    # gives the table of those rows, Player objects are only built by
+    # players() and iteration.
+    name: np.ndarray
+    team: np.ndarray
+    position: np.ndarray
+    news: np.ndarray
+    cost: np.ndarray
+    points: np.ndarray
+    xP: np.ndarray
+    teams: T.Tuple[str, ...]
+    positions: T.Tuple[str, ...] = ("GKP", "DEF", "MID", "FWD")
+    id: T.Optional[np.ndarray] = None
+
+    @staticmethod
+    def from_players(players: T.Iterable[Player]) -> "PlayerTable":
+        players = list(players)
+        teams = tuple(sorted(set(p.team for p in players), key=str))
+        positions: T.Tuple[str, ...] = ("GKP", "DEF", "MID", "FWD")
+        positions += tuple(sorted(set(p.position for p in players) - set(positions)))
+        team = {t: code for code, t in enumerate(teams)}
+        position = {p: code for code, p in enumerate(positions)}
+        return PlayerTable(
+            name=np.array([p.name for p in players], dtype=object),
+            team=np.array([team[p.team] for p in players], dtype=np.int64),
+            position=np.array([position[p.position] for p in players], dtype=np.int64),
+            news=np.array([p.news for p in players], dtype=object),
+            cost=np.array([p.cost for p in players]),
+            points=np.array([p.points for p in players]),
+            xP=np.array([p.xP for p in players], dtype=np.float64),
+            teams=teams,
+            positions=positions,
+        )
+
+    def __len__(self) -> int:
+        return len(self.name)
+
+    def __getitem__(self, rows: T.Union[slice, np.ndarray]) -> "PlayerTable":
+        return dataclasses.replace(
+            self,
+            name=self.name[rows],
+            team=self.team[rows],
+            position=self.position[rows],
+            news=self.news[rows],
+            cost=self.cost[rows],
+            points=self.points[rows],
+            xP=self.xP[rows],
+            id=None if self.id is None else self.id[rows],
+        )
+
+    def __iter__(self) -> T.Iterator[Player]:
+        return iter(self.players())
+
+    def code(self, position: str) -> int:
+        return self.positions.index(position)
+
+    def rows(self, ids: T.Sequence[int]) -> np.ndarray:
+        # Row of every element id, ids the table does not hold raise KeyError.
+        if self.id is None:
+            raise KeyError("PlayerTable without element ids")
+        wanted = np.asarray(ids, dtype=np.int64)
+        if not len(self) and len(wanted):
+            raise KeyError(f"Unknown element ids: {wanted.tolist()}")
+        sorter = np.argsort(self.id, kind="stable")
+        found = np.searchsorted(self.id, wanted, sorter=sorter)
+        rows = sorter[found.clip(max=max(len(self) - 1, 0))]
+        missing = wanted[(found == len(self)) | (self.id[rows] != wanted)]
+        if len(missing):
+            raise KeyError(f"Unknown element ids: {missing.tolist()}")
+        return rows
+
+    def players(self) -> T.List[Player]:
+        return [
+            Player(
+                name=name,
+                team=self.teams[team],
+                position=self.positions[position],
+                news=news,
+                cost=cost,
+                points=points,
+                xP=xp,
+            )
+            for name, team, position, news, cost, points, xp in zip(
+                self.name.tolist(),
+                self.team.tolist(),
+                self.position.tolist(),
+                self.news.tolist(),
+                self.cost.tolist(),
+                self.points.tolist(),
+                self.xP.tolist(),
+            )
+        ]
+
+
 @dataclasses.dataclass(frozen=True)
 class TransferConstraints:
     add: T.Tuple[str, ...]
@@ -45,3 +145,31 @@ class TransferConstraints:
     ignore: T.Tuple[str, ...]
     buget: int
     max_transfers: int
+
+
+@dataclasses.dataclass(frozen=True)
+class PlanConstraints:
+    horizon: int
+    buget: int
+    free_transfers: int = 1
+    max_banked: int = 2
+    max_transfers: int = 2
+    hit: float = 4.0
+    candidates: int = 5
+    width: int = 100
+
+
+@dataclasses.dataclass(frozen=True)
+class GameweekPlan:
+    gameweek: int
+    transfers: T.Tuple[T.Tuple[Player, Player], ...]
+    free_transfers: int
+    hits: int
+    xP: float
+
+
+@dataclasses.dataclass(frozen=True)
+class Distribution:
+    mean: float
+    variance: float
+    quantiles: T.Tuple[T.Tuple[float, float], ...]